@@ -1,27 +1,56 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import argparse
+import os
 import re
+import sys
 import pandas as pd
 import numpy as np
 
 
 # Directory where the current script is located
 SCRIPT_DIR = Path(__file__).parent.resolve() # BachelorProject/AUs
+
+# Make the shared helpers in BachelorProject/common importable
+sys.path.insert(0, str(SCRIPT_DIR.parent))
+from common.frame_store import FRAME_FORMAT, list_partitions, read_frames
+from common.incremental import merge_participants, read_existing
+from common.manifest import Manifest, code_version
+from common.online_stats import RunningStats
+from common.segment_labeler import infer_masks
+from common.turn_stats import rollup
+from common.stat_kernels import KERNELS_VERSION, grouped_stats, resolve_stats
+
 ROOT_DIR = SCRIPT_DIR.parent / "data" / "participant_folders" # BachelorProject/data/participant_folders
 FULL_TEST_PATH = SCRIPT_DIR.parent / "data" / "depression.csv" # BachelorProject/data/depression.csv
 OUTPUT_PATH = SCRIPT_DIR.parent / "data" / "au_aggregation.csv" # BachelorProject/data/au_aggregation.csv
+# Output of --sweep: the aggregation for several confidence thresholds, with a conf_thresh column
+SWEEP_PATH = SCRIPT_DIR.parent / "data" / "au_aggregation_sweep.csv" # BachelorProject/data/au_aggregation_sweep.csv
+# Which input file each participant's rows in OUTPUT_PATH were aggregated from, for --incremental
+MANIFEST_PATH = SCRIPT_DIR.parent / "data" / "au_aggregation_manifest.json" # BachelorProject/data/au_aggregation_manifest.json
 
 # Minimum confidence threshold for keeping the frames
 CONF_THRESH = 0.7
+# Thresholds --sweep uses when no list is given (0.5, 0.55, ..., 0.95)
+SWEEP_THRESHOLDS = [round(0.5 + 0.05 * i, 2) for i in range(10)]
 # If True, keep only rows where success == 1
 REQUIRE_SUCCESS = True
-# Speaker codes
-SPEAKING_CODE = 1
-LISTENING_CODE = 0
-
-# Load labels
-labels = pd.read_csv(FULL_TEST_PATH, sep=None, engine="python")
-# Remove accidental spaces from column names
-labels.columns = labels.columns.str.strip()
+# Columns of the long-format output
+OUTPUT_COLUMNS = ["person_id", "depressed", "segment_type", "AU", "stat", "value"]
+# Columns that identify a row of the output
+OUTPUT_KEYS = ["person_id", "segment_type", "AU", "stat"]
+# Number of participants aggregated at the same time (None = one per CPU core)
+WORKERS = None
+# Per participant AU statistics written by au_split_automation.py while labeling (XXX_CLNF_AUs_stats.csv)
+STATS_NAME = "CLNF_AUs_stats"
+# Per participant, per speaker turn AU sums written next to it (XXX_CLNF_AUs_turns.csv, see common/turn_stats.py)
+TURNS_NAME = "CLNF_AUs_turns"
+# How each statistic is computed from the running count/mean/M2 of a statistics file
+STATS_FROM_RUNNING = {
+    "mean": lambda stats, segment: stats.mean(segment),
+    "std":  lambda stats, segment: stats.std(segment, ddof=0),
+}
 
 
 def pick_col(df, candidates):
@@ -34,128 +63,170 @@ def pick_col(df, candidates):
     raise KeyError(f"None of {candidates} found in columns: {list(df.columns)}")
 
 
-# Identify the participant ID column and the binary depression label column
-pid_col = pick_col(labels, ["Participant_ID", "ParticipantID"])
-bin_col = pick_col(labels, ["PHQ_Binary", "PHQBinary", "PHQ8_Binary"])
+def load_depression_labels(path=FULL_TEST_PATH) -> dict:
+    """
+    Load depression.csv and return a dictionary where the key is the participant ID
+    and the value is its binary depression status
+    """
+    labels = pd.read_csv(path, sep=None, engine="python")
+    # Remove accidental spaces from column names
+    labels.columns = labels.columns.str.strip()
 
-labels[pid_col] = labels[pid_col].astype(int)
-# Create a dictionary where the key is the participant ID and the value is its depression status
-id2dep = dict(zip(labels[pid_col], labels[bin_col]))
+    # Identify the participant ID column and the binary depression label column
+    pid_col = pick_col(labels, ["Participant_ID", "ParticipantID"])
+    bin_col = pick_col(labels, ["PHQ_Binary", "PHQBinary", "PHQ8_Binary"])
 
-# Statistics to compute for each AU intensity column (*_r)
-R_STATS = {
-    "mean": np.mean,
-    "std":  np.std,
-}
+    labels[pid_col] = labels[pid_col].astype(int)
+    return dict(zip(labels[pid_col], labels[bin_col]))
+
+
+# Statistics to compute, by name from the kernel registry in common/stat_kernels.py (e.g. median, q25, iqr,
+# skew, kurtosis, frac_above_1, or any qNN / frac_above_X). All of them are computed in one grouped pass
+R_STATS = ["mean", "std"]
+# Statistics computed on the AU presence columns (*_c) instead of the intensities (*_r)
+PRESENCE_STATS = {"activation_rate"}
 
-def apply_stats(x, stats):
-    """Apply a dictionary of statistic functions to a vector x"""
-    x = pd.to_numeric(pd.Series(x), errors="coerce").dropna().values
-    if len(x) == 0:
-        return {k: np.nan for k in stats}
-    out = {}
-    for k, f in stats.items():
-        try:
-            out[k] = f(x)
-        except Exception:
-            out[k] = np.nan
-    return out
 
+def split_stats(stats=None):
+    """Kernels of the requested statistics (default R_STATS), split into intensity (*_r) and presence (*_c) ones"""
+    names = list(R_STATS if stats is None else stats)
+    return (resolve_stats([k for k in names if k not in PRESENCE_STATS]),
+            resolve_stats([k for k in names if k in PRESENCE_STATS]))
 
-def infer_masks(df: pd.DataFrame):
+
+def aggregate_frames(df: pd.DataFrame, masks: dict, pid, depressed, stats=None) -> pd.DataFrame:
+    """
+    Compute the requested statistics (default R_STATS) of every AU column for every segment mask of one
+    participant. The frames of all segments are stacked (a frame can be in several segments, e.g. "all" and
+    "speaking") and every statistic of every segment and AU column comes from one grouped pass.
+    Returns the long-format rows (segment -> AU -> stat order) for this participant
     """
-    Create boolean masks for:
-    - all frames;
-    - speaking frames;
-    - listening frames.
+    segment_types = [k for k, m in masks.items() if np.any(m)]
+    rows = [np.flatnonzero(np.asarray(masks[k], dtype=bool)) for k in segment_types]
+    segment_id = np.repeat(np.arange(len(rows)), [len(r) for r in rows])
+    stacked = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+    parts = []
+    for kernels, is_column in zip(split_stats(stats), (au_r_column, au_c_column)):
+        au_cols = [c for c in df.columns if is_column(c)]
+        if not kernels or not au_cols:
+            continue
+        values = df[au_cols].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)[stacked]
+        parts.append((au_cols, list(kernels), grouped_stats(values, segment_id, len(rows), kernels)))
+
+    return long_format(pid, depressed, segment_types, parts)
+
 
-    Returns a dictionary of masks
+def long_format(pid, depressed, segment_types, parts) -> pd.DataFrame:
     """
-    if "speaker" not in df.columns:
-        raise KeyError("Your AU file has no 'speaker' column.")
+    Long-format rows of one participant. parts holds (AU columns, stat names, values) with values a
+    (segments x AU columns x stats) array; rows come in segment -> AU -> stat order
+    """
+    per_segment = []
+    for i, segment_type in enumerate(segment_types):
+        for au_cols, stat_names, values in parts:
+            per_segment.append(pd.DataFrame({
+                "segment_type": segment_type,
+                "AU": np.repeat(au_cols, len(stat_names)),
+                "stat": np.tile(stat_names, len(au_cols)),
+                "value": np.asarray(values[i], dtype=np.float64).ravel(),
+            }))
+    if not per_segment:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS)
+    out = pd.concat(per_segment, ignore_index=True)
+    out.insert(0, "person_id", pid)
+    out.insert(1, "depressed", depressed)
+    return out[OUTPUT_COLUMNS]
 
-    sp = df["speaker"]
 
-    sp_num = pd.to_numeric(sp, errors="coerce")
-    numeric_fraction = sp_num.notna().mean()
+# Only the columns and frames the aggregation needs are read; for parquet files the
+# success/confidence filters are pushed down to the reader
+def au_r_column(c):
+    return c.startswith("AU") and c.endswith("_r")
 
-    # If almost all values are numeric, use numeric speaker codes
-    if numeric_fraction > 0.95:
-        speaking = sp_num == SPEAKING_CODE
-        listening = sp_num == LISTENING_CODE
-    else:
-        # Otherwise treat speaker labels as strings
-        s = sp.astype(str).str.strip().str.lower()
-        listening = s.eq("listening") | s.str.contains("listen")
-        speaking  = s.eq("speaking") | s.str.contains("speak")
-
-        if listening.sum() > 0 and speaking.sum() == 0:
-            speaking = ~listening
-        elif speaking.sum() > 0 and listening.sum() == 0:
-            listening = ~speaking
-
-    if listening.sum() == 0 and speaking.sum() == 0:
-        uniques = pd.Series(sp.dropna().unique()).astype(str).tolist()
-        raise RuntimeError(
-            "Could not create ANY masks.\n"
-            f"speaker dtype: {sp.dtype}\n"
-            f"unique speaker values: {uniques}\n"
-        )
 
-    allmask = pd.Series(True, index=df.index)
-    masks = {"all": allmask}
-    if speaking.sum() > 0:
-        masks["speaking"] = speaking
-    if listening.sum() > 0:
-        masks["listening"] = listening
-    return masks
+def au_c_column(c):
+    return c.startswith("AU") and c.endswith("_c")
 
 
-# Discover AU files recursively
-root = Path(ROOT_DIR)
-au_files = sorted(root.rglob("*_CLNF_AUs_labeled.csv"))
-print("Found AU files:", len(au_files))
+def keep_column(c):
+    return c in ("speaker", "success", "confidence") or au_r_column(c)
 
-if len(au_files) == 0:
-    raise RuntimeError("No *_CLNF_AUs_labeled.csv files found. ROOT_DIR is wrong.")
 
-rows = []
-printed_speaker_values = False
-printed_segment_counts = False
+def keep_presence_column(c):
+    return keep_column(c) or au_c_column(c)
 
-for au_file in au_files:
-    # Extract participant ID from filename, e.g. "123_CLNF_AUs_labeled.csv" -> 123
-    m = re.match(r"^(\d+)_CLNF_AUs_labeled\.csv$", au_file.name)
+
+FRAME_FILTERS = []
+if REQUIRE_SUCCESS:
+    FRAME_FILTERS.append(("success", "==", 1))
+if CONF_THRESH is not None:
+    FRAME_FILTERS.append(("confidence", ">=", CONF_THRESH))
+
+
+def participant_id(path) -> int:
+    """
+    Participant ID of a labeled AU file, e.g. "123_CLNF_AUs_labeled.csv" -> 123,
+    or ".../person_id=123/part-0.parquet" -> 123 for the parquet store
+    """
+    path = Path(path)
+    if path.parent.name.startswith("person_id="):
+        return int(path.parent.name.split("=", 1)[1])
+    m = re.match(r"^(\d+)_CLNF_AUs_(?:labeled|stats|turns)\.csv$", path.name)
     if not m:
-        continue
-    pid = int(m.group(1))
+        raise ValueError(f"Cannot read a participant ID from {path}")
+    return int(m.group(1))
 
-    df = pd.read_csv(au_file)
-    df.columns = df.columns.str.strip()
 
-    if not printed_speaker_values:
-        print("Speaker unique values (first file):",
-              pd.Series(df["speaker"].dropna().unique()).astype(str).tolist()[:30])
-        print("Frames before filters:", len(df))
-        printed_speaker_values = True
+def stats_path(folder, pid) -> Path:
+    """Statistics file of a participant, next to its speaker segments"""
+    return Path(folder) / f"{pid}_{STATS_NAME}.csv"
 
-    # Keep only SUCCESS frames, if requested
-    if REQUIRE_SUCCESS and "success" in df.columns:
-        df = df[df["success"] == 1]
-    # Keep only confident frames, if requested
-    if CONF_THRESH is not None and "confidence" in df.columns:
-        df = df[df["confidence"] >= CONF_THRESH]
 
-    if printed_speaker_values:
-        print("Frames after filters (first file):", len(df))
-        printed_speaker_values = False
+def turns_path(folder, pid) -> Path:
+    """Per turn statistics file of a participant, next to its speaker segments"""
+    return Path(folder) / f"{pid}_{TURNS_NAME}.csv"
 
-    if len(df) == 0:
-        continue
 
-    depressed = id2dep.get(pid, np.nan)
+def find_stats_files(root_dir=ROOT_DIR) -> list:
+    """Statistics files written while labeling, recursively in the participant folders"""
+    return [f for f in sorted(Path(root_dir).rglob(f"*_{STATS_NAME}.csv"))
+            if re.match(rf"^\d+_{STATS_NAME}\.csv$", f.name)]
 
-    au_r_cols = [c for c in df.columns if c.startswith("AU") and c.endswith("_r")]
+
+def find_turn_files(root_dir=ROOT_DIR) -> list:
+    """Per turn statistics files written while labeling, recursively in the participant folders"""
+    return [f for f in sorted(Path(root_dir).rglob(f"*_{TURNS_NAME}.csv"))
+            if re.match(rf"^\d+_{TURNS_NAME}\.csv$", f.name)]
+
+
+def find_au_files(root_dir=ROOT_DIR) -> list:
+    """Labeled AU files, recursively in the participant folders or the partitions of the parquet store"""
+    if FRAME_FORMAT == "parquet":
+        return list(list_partitions("CLNF_AUs_labeled").values())
+    # Only files named like "123_CLNF_AUs_labeled.csv"
+    return [f for f in sorted(Path(root_dir).rglob("*_CLNF_AUs_labeled.csv"))
+            if re.match(r"^\d+_CLNF_AUs_labeled\.csv$", f.name)]
+
+
+def aggregate_participant(path, verbose=False, stats=None) -> pd.DataFrame:
+    """
+    Read one labeled AU file, keep the frames that pass the success/confidence filters and return its
+    long-format statistics (OUTPUT_COLUMNS) for the stat names in stats (default R_STATS).
+    The depressed column is left empty; main() fills it in.
+    With verbose, the speaker values and segment counts are printed as a sanity check
+    """
+    pid = participant_id(path)
+    presence = any(k in PRESENCE_STATS for k in (R_STATS if stats is None else stats))
+    df = read_frames(path, columns=keep_presence_column if presence else keep_column, filters=FRAME_FILTERS)
+
+    if verbose:
+        print("Speaker unique values (first file):",
+              pd.Series(df["speaker"].dropna().unique()).astype(str).tolist()[:30])
+        print("Frames after filters (first file):", len(df))
+
+    if len(df) == 0:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS)
 
     masks = infer_masks(df)
 
@@ -163,37 +234,273 @@ for au_file in au_files:
         missing = "listening" if "speaking" in masks else "speaking"
         print(f"PID {pid} — missing '{missing}' segment, only has: {[k for k in masks if k != 'all']}")
 
-    if not printed_segment_counts:
+    if verbose:
         print("Example segment counts:", {k: int(v.sum()) for k, v in masks.items()})
-        printed_segment_counts = True
 
+    return aggregate_frames(df, masks, pid, np.nan, stats)
+
+
+def aggregate_stats(path, stats=None) -> pd.DataFrame:
+    """
+    Long-format statistics of one participant from its statistics file (written by au_split_automation.py
+    while labeling), without reading any frame. Only works for statistics in STATS_FROM_RUNNING
+    """
+    names = list(R_STATS if stats is None else stats)
+    unsupported = [k for k in names if k not in STATS_FROM_RUNNING]
+    if unsupported:
+        raise ValueError(f"{unsupported} cannot be computed from the running statistics; aggregate the frames instead")
+
+    running = RunningStats.load(path)
+    segment_types = running.groups
+    values = np.array([np.column_stack([STATS_FROM_RUNNING[k](running, g) for k in names]) for g in segment_types])
+    return long_format(participant_id(path), np.nan, segment_types, [(running.columns, names, values)])
+
+
+def aggregate_turns(path, stats=None) -> pd.DataFrame:
+    """
+    Long-format statistics of one participant rolled up from its per turn statistics file (written by
+    au_split_automation.py while labeling), without reading any frame. The roles of the turns are assigned to
+    speaking/listening with infer_masks, as the frames are. Only works for statistics in STATS_FROM_RUNNING
+    """
+    names = list(R_STATS if stats is None else stats)
+    unsupported = [k for k in names if k not in STATS_FROM_RUNNING]
+    if unsupported:
+        raise ValueError(f"{unsupported} cannot be computed from the turn statistics; aggregate the frames instead")
+
+    store = pd.read_csv(path)
+    pid = participant_id(path)
+    if store.empty:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS)
+
+    # One row per frame of every role (the values counted in its best filled column), for infer_masks.
+    # A role whose values are all missing still has frames, so it gets one row as well
+    frames = store.groupby(["role", "column"], sort=False)["n"].sum().groupby(level="role", sort=False).max()
+    frames = frames.clip(lower=1)
+    roles = pd.DataFrame({"speaker": frames.index.to_series().repeat(frames.to_numpy()).to_numpy()})
+    masks = infer_masks(roles)
+
+    parts = []
     for segment_type, mask in masks.items():
-        seg = df[mask]
-        if len(seg) == 0:
-            continue
+        members = roles["speaker"][np.asarray(mask, dtype=bool)].unique()
+        rows = store[store["role"].isin(members)].assign(segment_type=segment_type)
+        # As in aggregate_participant, a segment with frames but without values gives NaN rows
+        if not rows.empty:
+            parts.append(rollup(rows, "session", ddof=0, by=("person_id", "segment_type")))
+    if not parts:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS)
+
+    rolled = pd.concat(parts, ignore_index=True)
+    segment_types = list(dict.fromkeys(rolled["segment_type"]))
+    columns = list(dict.fromkeys(store["column"]))
+    values = np.array([
+        rolled[rolled["segment_type"] == segment_type].set_index("column").reindex(columns)[names].to_numpy()
+        for segment_type in segment_types
+    ])
+    return long_format(pid, np.nan, segment_types, [(columns, names, values)])
+
+
+# Statistics --sweep can compute from cumulative sums
+SWEEP_STATS = ["mean", "std"]
+
+
+def sweep_participant(path, verbose=False, stats=None, thresholds=SWEEP_THRESHOLDS) -> pd.DataFrame:
+    """
+    aggregate_participant for several confidence thresholds from one read of the file. The frames are sorted by
+    confidence (highest first) and the count, sum and sum of squares of every AU column are summed up cumulatively
+    per segment, so the frames kept at a threshold are a prefix and each threshold is one lookup.
+    Only mean and std (SWEEP_STATS) can be computed this way. Returns the rows with a conf_thresh column
+    """
+    names = list(SWEEP_STATS if stats is None else stats)
+    unsupported = [k for k in names if k not in SWEEP_STATS]
+    if unsupported:
+        raise ValueError(f"{unsupported} cannot be swept with cumulative sums; only {SWEEP_STATS}")
+    columns = ["conf_thresh"] + OUTPUT_COLUMNS
+
+    pid = participant_id(path)
+    # Every filter but the confidence one; frames below the lowest threshold are never kept
+    filters = [f for f in FRAME_FILTERS if f[0] != "confidence"] + [("confidence", ">=", min(thresholds))]
+    df = read_frames(path, columns=keep_column, filters=filters)
+    if verbose:
+        print("Frames above the lowest threshold (first file):", len(df))
+    if len(df) == 0:
+        return pd.DataFrame(columns=columns)
+
+    masks = infer_masks(df)
+    au_cols = [c for c in df.columns if au_r_column(c)]
+
+    order = np.argsort(-df["confidence"].to_numpy(dtype=np.float64), kind="stable")
+    confidence = df["confidence"].to_numpy(dtype=np.float64)[order]
+    values = df[au_cols].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)[order]
+    present = ~np.isnan(values)
+    # Sums are taken around each column's mean, so the sum of squares keeps its precision
+    with np.errstate(invalid="ignore"):
+        shift = np.where(present.any(axis=0), np.nanmean(np.where(present, values, np.nan), axis=0), 0.0)
+    x = np.where(present, values - shift, 0.0)
+
+    # Number of frames with confidence >= t, for every threshold (confidence is sorted from high to low)
+    cuts = np.searchsorted(-confidence, -np.asarray(thresholds, dtype=np.float64), side="right")
+
+    segment_sums = {}
+    for segment_type, mask in masks.items():
+        m = np.asarray(mask, dtype=bool)[order]
+        frames = np.concatenate([[0], np.cumsum(m)])
+        sums = [np.cumsum(a, axis=0) for a in (present & m[:, None], np.where(m[:, None], x, 0.0), np.where(m[:, None], x * x, 0.0))]
+        # A leading row of zeros, so a cut of k frames reads row k
+        segment_sums[segment_type] = [frames] + [np.vstack([np.zeros((1, len(au_cols))), a]) for a in sums]
+
+    out = []
+    for t, k in zip(thresholds, cuts):
+        segment_types, values_at = [], []
+        for segment_type, (frames, n, s, q) in segment_sums.items():
+            # As in aggregate_participant, a segment without any frame is left out
+            if frames[k] == 0:
+                continue
+            with np.errstate(invalid="ignore", divide="ignore"):
+                n_k = n[k]
+                centred = s[k] / n_k
+                var = np.maximum(q[k] / n_k - centred ** 2, 0.0)
+                result = {"mean": np.where(n_k > 0, shift + centred, np.nan), "std": np.where(n_k > 0, np.sqrt(var), np.nan)}
+            segment_types.append(segment_type)
+            values_at.append(np.column_stack([result[name] for name in names]))
+        if segment_types:
+            rows = long_format(pid, np.nan, segment_types, [(au_cols, names, np.array(values_at))])
+            rows.insert(0, "conf_thresh", t)
+            out.append(rows)
+    return pd.concat(out, ignore_index=True) if out else pd.DataFrame(columns=columns)
+
+
+def aggregate_all(au_files, workers=WORKERS, stats=None, aggregate=aggregate_participant) -> pd.DataFrame:
+    """
+    Aggregate every labeled AU file with a process pool. The results are concatenated in the order of
+    au_files, so the output does not depend on which worker finishes first.
+    aggregate is the per file function (aggregate_participant, or sweep_participant for --sweep)
+    """
+    au_files = list(au_files)
+    if not au_files:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS)
+
+    aggregate = partial(aggregate, stats=stats)
+    # The first file is aggregated here so its sanity check is printed once, before the workers start
+    results = [aggregate(au_files[0], verbose=True)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(au_files) == 1:
+        results += [aggregate(f) for f in au_files[1:]]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results += list(pool.map(aggregate, au_files[1:]))
+
+    results = [r for r in results if not r.empty]
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=OUTPUT_COLUMNS)
+
+
+def sweep(au_files, thresholds, workers=WORKERS, stats=None):
+    """Write SWEEP_PATH: the long-format aggregation of every participant for every threshold"""
+    if not au_files:
+        raise RuntimeError("No *_CLNF_AUs_labeled.csv files found. ROOT_DIR is wrong.")
+    out = aggregate_all(au_files, workers, stats, partial(sweep_participant, thresholds=thresholds))
+    # One block per threshold, each in the order of au_aggregation.csv
+    out = out.sort_values("conf_thresh", kind="stable", ignore_index=True)
+    id2dep = load_depression_labels()
+    out["depressed"] = pd.to_numeric(out["person_id"].map(id2dep), errors="coerce")
+    out.to_csv(SWEEP_PATH, index=False)
+    print(f"Saved {len(thresholds)} thresholds, {len(out)} rows:", SWEEP_PATH)
+
+
+def aggregation_version(stats) -> str:
+    """Manifest version of the output: the aggregation code (filters included) and the requested statistics"""
+    return f"{code_version(__file__)}-{KERNELS_VERSION}:{','.join(stats)}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS,
+                        help="number of participants aggregated in parallel (default: one per CPU core)")
+    parser.add_argument("--stats", default=",".join(R_STATS),
+                        help="comma separated statistics to compute (default: %(default)s), "
+                             "e.g. mean,std,median,iqr,skew,kurtosis,q10,frac_above_1,activation_rate")
+    parser.add_argument("--from-stats", action="store_true",
+                        help="use the XXX_CLNF_AUs_stats.csv files written while labeling instead of reading the frames")
+    parser.add_argument("--from-turns", action="store_true",
+                        help="roll the aggregation up from the XXX_CLNF_AUs_turns.csv files written while labeling "
+                             "instead of reading the frames")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only aggregate participants that are new or whose files changed since the last run "
+                             "and merge them into the existing au_aggregation.csv")
+    parser.add_argument("--sweep", nargs="?", const=",".join(map(str, SWEEP_THRESHOLDS)), default=None,
+                        metavar="THRESHOLDS",
+                        help="aggregate for several comma separated confidence thresholds in one pass over the frames "
+                             "and write au_aggregation_sweep.csv (default thresholds: %(const)s)")
+    args = parser.parse_args()
+    stats = [k.strip() for k in args.stats.split(",") if k.strip()]
+    # Fail on unknown names before any file is read
+    split_stats(stats)
+
+    au_files = find_au_files()
+    print("Found AU files:", len(au_files))
+
+    if args.sweep is not None:
+        if args.from_stats or args.from_turns or args.incremental:
+            parser.error("--sweep reads the frames; it cannot be combined with --from-stats, --from-turns or --incremental")
+        thresholds = sorted(float(t) for t in args.sweep.split(",") if t.strip())
+        sweep(au_files, thresholds, args.workers, stats)
+        return
+
+    if args.from_stats and args.from_turns:
+        parser.error("use either --from-stats or --from-turns")
+    # Participants with a statistics (or turn statistics) file are aggregated from it, the others from their frames
+    stats_files, aggregate_summary = [], None
+    if args.from_stats:
+        stats_files, aggregate_summary = find_stats_files(), aggregate_stats
+    elif args.from_turns:
+        stats_files, aggregate_summary = find_turn_files(), aggregate_turns
+    if aggregate_summary is not None:
+        with_stats = {participant_id(f) for f in stats_files}
+        au_files = [f for f in au_files if participant_id(f) not in with_stats]
+        print(f"Found statistics files: {len(stats_files)}, AU files without statistics: {len(au_files)}")
+
+    if len(au_files) == 0 and len(stats_files) == 0:
+        raise RuntimeError("No *_CLNF_AUs_labeled.csv files found. ROOT_DIR is wrong.")
+
+    # The file every participant is aggregated from is recorded, so a later --incremental run can tell what changed
+    manifest = Manifest(MANIFEST_PATH)
+    version = aggregation_version(stats)
+    inputs = manifest.fingerprints(OUTPUT_PATH, {str(participant_id(f)): f for f in au_files + stats_files})
+    delta = manifest.changed_inputs(OUTPUT_PATH, inputs, version) if args.incremental else None
+    if delta is not None:
+        changed, removed = delta
+        au_files = [f for f in au_files if str(participant_id(f)) in changed]
+        stats_files = [f for f in stats_files if str(participant_id(f)) in changed]
+        print(f"Incremental: {len(changed)} new or changed participants, {len(removed)} removed")
+
+    # Create final long-format DataFrame
+    out = aggregate_all(au_files, args.workers, stats)
+    if stats_files:
+        # Participants from both sources are put back in participant order
+        parts = [p for p in [out] + [aggregate_summary(f, stats) for f in stats_files] if not p.empty]
+        if parts:
+            out = pd.concat(parts, ignore_index=True).sort_values("person_id", kind="stable", ignore_index=True)
+    print("Produced rows:", len(out))
+
+    if delta is not None:
+        # Rows of unchanged participants are taken over from the last run
+        out = merge_participants(read_existing(OUTPUT_PATH, OUTPUT_COLUMNS), out, changed | removed,
+                                 keys=OUTPUT_KEYS, sort_by="person_id")
+        print("Rows after merging with the existing output:", len(out))
+
+    if out.empty:
+        raise RuntimeError(
+            "Produced 0 rows. Debug by setting CONF_THRESH=None and REQUIRE_SUCCESS=False.\n"
+            "Also verify that filters are not removing all frames."
+        )
+
+    # The labels are joined again for every participant, so edits to depression.csv are always picked up
+    id2dep = load_depression_labels()
+    out["depressed"] = pd.to_numeric(out["person_id"].map(id2dep), errors="coerce")
+    out.to_csv(OUTPUT_PATH, index=False)
+    manifest.record(OUTPUT_PATH, inputs, version)
+    manifest.save()
+    print("Saved:", OUTPUT_PATH)
+
 
-        for col in au_r_cols:
-            stats = apply_stats(seg[col], R_STATS)
-            for stat, val in stats.items():
-                rows.append({
-                    "person_id": pid,
-                    "depressed": depressed,
-                    "segment_type": segment_type,
-                    "AU": col,
-                    "stat": stat,
-                    "value": float(val) if pd.notna(val) else np.nan
-                })
-
-# Create final long-format DataFrame
-out = pd.DataFrame(rows, columns=["person_id", "depressed", "segment_type", "AU", "stat", "value"])
-print("Produced rows:", len(out))
-
-if out.empty:
-    raise RuntimeError(
-        "Produced 0 rows. Debug by setting CONF_THRESH=None and REQUIRE_SUCCESS=False.\n"
-        "Also verify that filters are not removing all frames."
-    )
-
-out["depressed"] = pd.to_numeric(out["depressed"], errors="coerce")
-out.to_csv(OUTPUT_PATH, index=False)
-print("Saved:", OUTPUT_PATH)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,6 @@
+import sys
+import argparse
 import pandas as pd
-import numpy as np
-import statsmodels.formula.api as smf
-from statsmodels.stats.multitest import multipletests
 from pathlib import Path
 
 # PATHS
@@ -9,6 +8,21 @@ SCRIPT_DIR = Path(__file__).parent.resolve() # BachelorProject/au
 DATA_DIR = SCRIPT_DIR.parent / "data"  # BachelorProject/data
 OUTPUT_DIR =SCRIPT_DIR.parent / "output" / "au" # BachelorProject/output/au
 INPUT_PATH = DATA_DIR / "au_aggregation.csv" # BachelorProject/data/au_aggregation.csv
+# Null distributions of earlier runs, reused by runs with the same data and seed
+CACHE_DIR = DATA_DIR / "permutation_cache" # BachelorProject/data/permutation_cache
+
+N_PERM = 5000
+# Seed of the permutations unless --seed or --fresh-seed is given, so reruns reuse the cached null distributions
+SEED = 0
+
+# Processes the (AU, stat, permutation block) tasks are spread over; None = one per CPU core
+WORKERS = None
+# Significance threshold (Bonferroni over the 14 AUs)
+ALPHA = 0.05/14
+
+# Make the shared helpers in BachelorProject/common importable
+sys.path.insert(0, str(SCRIPT_DIR.parent))
+from common.permutation import Checkpoint, InteractionDesign, NullCache, p_value, run_permutations
 
 def prepare_data(file):
     data = pd.read_csv(file)
@@ -18,82 +32,96 @@ def prepare_data(file):
     ]
     return data_filtered
 
-def permutation_test_interaction(df, n_perm=5000):
+def permutation_test_interaction(df, n_perm=N_PERM, seed=None, workers=WORKERS, adaptive=False, checkpoint=None,
+                                 cache=None, metrics=("mean", "std")):
     """
-    Takes clean data and number of permutations
-    Returns p-values for each AU score
+    Takes clean data, number of permutations, seed and number of worker processes
+    With adaptive, an AU stops drawing permutations once p < ALPHA is settled
+    With a checkpoint, completed permutation blocks are saved (and reused when resuming)
+    With a cache, permutation blocks of earlier runs are reused
+    Returns p-values and the number of permutations used for each AU score and metric
     """
+    # value ~ depressed * segment_type per AU and metric, set up once for all permutations
+    designs = {}
+    for metric in metrics:
+        df_metric = df[df["stat"] == metric]
+        for au in df_metric["AU"].unique():
+            designs[f"{metric}/{au}"] = InteractionDesign(df_metric[df_metric["AU"] == au])
 
-    results = []
-
-    aus = df["AU"].unique()
-
-    for au in aus:
-        df_au = df[df["AU"] == au].copy()
-
-        # Ensure categorical
-        df_au["segment_type"] = df_au["segment_type"].astype("category")
-
-        # --- Fit real model ---
-        model = smf.ols("value ~ depressed * segment_type", data=df_au).fit()
-
-        # Get correct interaction term name dynamically
-        interaction_term = [t for t in model.params.index if "depressed:segment_type" in t][0]
-        T_obs = model.tvalues[interaction_term]
+    # Interaction t of every subject level shuffle of depressed, every (AU, stat, block) a task of the pool
+    T_perms = run_permutations(designs, n_perm, seed, workers, alpha=ALPHA if adaptive else None,
+                               checkpoint=checkpoint, cache=cache)
 
-        # --- Prepare subject-level labels ---
-        subjects = df_au[["person_id", "depressed"]].drop_duplicates()
-
-        T_perm = []
-
-        for _ in range(n_perm):
-            # Shuffle depression at subject level
-            shuffled = subjects.copy()
-            shuffled["depressed"] = np.random.permutation(shuffled["depressed"].values)
-
-            # Merge back
-            df_perm = df_au.drop(columns="depressed").merge(shuffled, on="person_id")
-
-            # Fit model
-            model_perm = smf.ols("value ~ depressed * segment_type", data=df_perm).fit()
-
-            T_perm.append(model_perm.tvalues[interaction_term])
+    results = []
 
-        T_perm = np.array(T_perm)
+    for name, design in designs.items():
+        metric, au = name.split("/", 1)
+        T_obs = design.observed()
 
         # Two-sided p-value
-        p_value = np.mean(np.abs(T_perm) >= np.abs(T_obs))
+        p_value_au = p_value(T_obs, T_perms[name])
 
         results.append({
             "AU": au,
             "T_obs": T_obs,
-            "p_value": p_value,
-            "significant": p_value < (0.05/14)
+            "p_value": p_value_au,
+            "significant": p_value_au < ALPHA,
+            "n_perm": len(T_perms[name]),
+            "stat": metric
         })
 
     results_df = pd.DataFrame(results)
 
     return results_df
 
-def main(input_file, n_perm, output_folder):
+def main(input_file, n_perm, output_folder, seed=None, workers=WORKERS, adaptive=False, resume=False, cache=True, fresh_seed=False):
     data = prepare_data(input_file)
-    results = []
 
-    for metric in ["mean", "std"]:
-        df_metric = data[data["stat"] == metric].copy()
-        res_df = permutation_test_interaction(df_metric, n_perm)
-        res_df["stat"] = metric
-        results.append(res_df)
+    # Completed permutation blocks are saved here while the run is going, for --resume
+    checkpoint = Checkpoint(Path(output_folder) / "permutation_checkpoint", seed, resume, None if fresh_seed else SEED)
+    seed = checkpoint.seed
+    print("Seed:", seed)
 
-    results_df = pd.concat(results, ignore_index=True)
+    results_df = permutation_test_interaction(data, n_perm, seed, workers, adaptive, checkpoint,
+                                              NullCache(CACHE_DIR) if cache else None)
+    if adaptive:
+        print(f"Adaptive: {results_df['n_perm'].sum()} of {n_perm * len(results_df)} permutations drawn")
     output_path = Path(output_folder) / "au_permutation.csv"
     results_df.to_csv(output_path, index=False)
     print("Saved:", output_path)
+    checkpoint.clear()
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS,
+                        help="number of worker processes (default: one per CPU core)")
+    parser.add_argument("-n", "--n-perm", type=int, default=N_PERM,
+                        help="number of permutations per AU and stat (default: %(default)s)")
+    seeds = parser.add_mutually_exclusive_group()
+    seeds.add_argument("--seed", type=int, default=None,
+                       help="seed of the permutations; the same seed gives the same p-values "
+                            f"for any number of workers (default: {SEED})")
+    seeds.add_argument("--fresh-seed", action="store_true",
+                       help="draw a fresh seed (printed) instead of the default one; such a run cannot reuse the cache")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="stop drawing permutations for an AU once its p-value is clearly above or below "
+                             "the threshold; n_perm is then the maximum")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its last completed permutation blocks "
+                             "(with its seed, unless --seed is given)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="draw every permutation again instead of reusing the ones cached by earlier runs")
+    args = parser.parse_args()
+
     main(
         input_file=INPUT_PATH,
         output_folder=OUTPUT_DIR,
-        n_perm=5000
-    )
\ No newline at end of file
+        n_perm=args.n_perm,
+        seed=args.seed,
+        workers=args.workers,
+        adaptive=args.adaptive,
+        resume=args.resume,
+        cache=not args.no_cache,
+        fresh_seed=args.fresh_seed
+    )
@@ -1,30 +1,52 @@
+import argparse
 import os
 import glob
 import subprocess
 import sys
 import zipfile
 import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 # Absolute path of the folder where this script is located
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Make the shared helpers in BachelorProject/common importable
+sys.path.insert(0, os.path.join(SCRIPT_DIR, ".."))
+from common.participant_archive import AUS_SUFFIX, TRANSCRIPT_SUFFIX, find_member, read_member_text
+from common.manifest import Manifest, code_version
+from common.online_stats import STATS_VERSION, SegmentStats
+from common.turn_stats import TURN_STATS_VERSION, TurnStats
+from common.segment_labeler import OVERLAP_POLICIES, STREAMS, SegmentIndex, label_streams, labeled_path, labeler_version
+from ellie_participant_split import split_transcript
+from au_aggregation import FRAME_FILTERS, au_r_column, stats_path, turns_path
+
 # Absolute paths to the two helper scripts
 SPEAKER_SCRIPT = os.path.join(SCRIPT_DIR, "ellie_participant_split.py")
 AUS_SCRIPT = os.path.join(SCRIPT_DIR, "au_split.py")
 
 BASE_DIR = os.path.join(SCRIPT_DIR, "..", "data", "participant_folders")
 
+# Version of the code that builds the segments; editing it rebuilds every segments file
+# (labeled files use the version of the shared labeling engine)
+SEGMENTS_VERSION = code_version(SPEAKER_SCRIPT)
+
 # Delete the zip files after successful extraction
 DELETE_ZIPS_AFTER_EXTRACT = True
 
+# Number of participant folders processed at the same time (None = one per CPU core)
+WORKERS = None
+
+# Read the transcript and AU files straight out of the *_P.zip archives instead of extracting them
+READ_FROM_ZIP = False
+
 
 def run(cmd, cwd):
     print("\n>>>", " ".join(cmd))
     r = subprocess.run(cmd, cwd=cwd)
     if r.returncode != 0:
         print("!! Failed in:", cwd)
-        sys.exit(r.returncode)
+        raise RuntimeError(f"{os.path.basename(cmd[1])} exited with code {r.returncode}")
 
 
 def _flatten_single_nested_dir(target_dir: str):
@@ -49,6 +71,14 @@ def _flatten_single_nested_dir(target_dir: str):
         shutil.rmtree(nested)
 
 
+def _has_inputs(folder: str) -> bool:
+    """True if a participant folder holds the transcript and AU files (not only outputs written by --from-zip)"""
+    return all(
+        glob.glob(os.path.join(folder, "**", f"*{suffix}"), recursive=True)
+        for suffix in (TRANSCRIPT_SUFFIX, AUS_SUFFIX)
+    )
+
+
 def unzip_archives_on_desktop():
     # Find all zip files in BASE_DIR whose names end with "_P.zip"
     zips = sorted(glob.glob(os.path.join(BASE_DIR, "*_P.zip")))
@@ -59,7 +89,8 @@ def unzip_archives_on_desktop():
         base = os.path.splitext(os.path.basename(zip_path))[0]
         out_dir = os.path.join(BASE_DIR, base)
 
-        if os.path.isdir(out_dir) and os.listdir(out_dir):
+        # A folder written by --from-zip only holds outputs, so its archive is still extracted
+        if os.path.isdir(out_dir) and _has_inputs(out_dir):
             continue
 
         os.makedirs(out_dir, exist_ok=True)
@@ -100,66 +131,270 @@ def cleanup_folder_keep_only(folder: str, keep_paths):
     print(f"Cleanup done in {os.path.basename(folder)}. Deleted {deleted} file(s)")
 
 
-def main():
-    unzip_archives_on_desktop()
-
-    folders = sorted(
-        [
-            os.path.join(BASE_DIR, d)
-            for d in os.listdir(BASE_DIR)
-            if os.path.isdir(os.path.join(BASE_DIR, d)) and d.endswith("_P")
-        ]
-    )
+def build_outputs(folder_name, transcript, streams, segments_out, force=False, use_subprocess=False, chunksize=None,
+                  policy="last", label_gaps=False) -> str:
+    """
+    Create XXX_speaker_segments.csv and a labeled file for every CLNF stream (AUs, gaze and pose when present),
+    skipping each output whose inputs and code did not change since it was last built (recorded in
+    XXX_manifest.json next to the outputs). All streams are labeled against one segment index.
+    transcript and the values of streams (stream name -> source) are file paths or (zip_path, member) tuples.
+    With chunksize, frames are labeled in chunks of that many rows to keep memory bounded; policy and label_gaps
+    decide how overlapping turns and frames outside every turn are labeled (see common/segment_labeler.py).
+    Unless use_subprocess is set, the per segment AU statistics used by au_aggregation.py --from-stats and the
+    per turn AU statistics are accumulated while labeling (XXX_CLNF_AUs_stats.csv and XXX_CLNF_AUs_turns.csv).
+    Returns "done" if anything was rebuilt, otherwise "up to date"
+    """
+    folder = os.path.dirname(segments_out)
+    prefix = folder_name.split("_", 1)[0]
+    manifest = Manifest(manifest_path(segments_out))
+    version = labeler_version(policy, label_gaps)
+
+    segments_inputs = manifest.fingerprints(segments_out, {"transcript": transcript})
+    rebuild_segments = force or not manifest.is_up_to_date(segments_out, segments_inputs, SEGMENTS_VERSION)
+    if rebuild_segments:
+        if use_subprocess:
+            run(["python", SPEAKER_SCRIPT, transcript, "-o", segments_out], cwd=folder)
+        else:
+            source = read_member_text(*transcript) if isinstance(transcript, tuple) else transcript
+            segments = split_transcript(source, segments_out)
+            print(f"[{folder_name}] {len(segments)} segments")
+    manifest.record(segments_out, segments_inputs, SEGMENTS_VERSION)
+
+    # The AU statistics (per segment and per turn) are computed while the AUs are labeled, with the frame
+    # filters of au_aggregation.py, so they are rebuilt together with the labeled AU file (and when the filters change).
+    # Maps each statistics file to its manifest version and a factory for its accumulator
+    stats_outputs = {} if use_subprocess else {
+        str(stats_path(folder, prefix)): (
+            f"{version}:{STATS_VERSION}:{FRAME_FILTERS!r}",
+            lambda: SegmentStats(au_r_column, FRAME_FILTERS),
+        ),
+        str(turns_path(folder, prefix)): (
+            f"{version}:{TURN_STATS_VERSION}:{FRAME_FILTERS!r}",
+            lambda: TurnStats(int(prefix), au_r_column, FRAME_FILTERS),
+        ),
+    }
+
+    # The segments file is an input as well, so a changed transcript also relabels every stream
+    stale = {}
+    for name, source in streams.items():
+        out = str(labeled_path(name, folder, prefix))
+        inputs = manifest.fingerprints(out, {"segments": segments_out, name: source})
+        up_to_date = manifest.is_up_to_date(out, inputs, version)
+        if name == "aus":
+            up_to_date = up_to_date and all(
+                manifest.is_up_to_date(path, inputs, stats_version) for path, (stats_version, _) in stats_outputs.items()
+            )
+        if force or not up_to_date:
+            stale[name] = (source, out, inputs)
+        else:
+            manifest.record(out, inputs, version)
+
+    if stale:
+        if use_subprocess:
+            source, out, _ = stale["aus"]
+            cmd = ["python", AUS_SCRIPT, segments_out, source, "-o", out, "--overlap-policy", policy]
+            if label_gaps:
+                cmd.append("--label-gaps")
+            if chunksize is not None:
+                cmd += ["--chunksize", str(chunksize)]
+            run(cmd, cwd=folder)
+        else:
+            index = SegmentIndex.from_csv(segments_out, policy=policy, label_gaps=label_gaps)
+            accumulators = {path: make() for path, (_, make) in stats_outputs.items()} if "aus" in stale else {}
+            counts = label_streams(
+                index,
+                {name: source for name, (source, _, _) in stale.items()},
+                {name: out for name, (_, out, _) in stale.items()},
+                chunksize=chunksize,
+                stats={"aus": list(accumulators.values())},
+            )
+            for name, (kept, total) in counts.items():
+                print(f"[{folder_name}] {name}: kept {kept} of {total} rows")
+            for path, accumulator in accumulators.items():
+                accumulator.save(path)
+                manifest.record(path, stale["aus"][2], stats_outputs[path][0])
+        for name, (_, out, inputs) in stale.items():
+            manifest.record(out, inputs, version)
+
+    manifest.save()
+
+    if not (rebuild_segments or stale):
+        print(f"[{folder_name}] Up to date, nothing to do")
+        return "up to date"
+    return "done"
+
+
+def manifest_path(segments_out) -> str:
+    """XXX_manifest.json in the same participant folder as the segments file"""
+    folder = os.path.dirname(segments_out)
+    prefix = os.path.basename(folder).split("_", 1)[0]
+    return os.path.join(folder, f"{prefix}_manifest.json")
+
+
+def process_participant(folder: str, use_subprocess: bool = False, force: bool = False, **labeling) -> str:
+    """
+    Create the speaker segments and the labeled AU, gaze and pose files for one participant folder,
+    then clean the folder up. With use_subprocess only the AU file is labeled, by au_split.py.
+    labeling holds the chunksize, policy and label_gaps options of build_outputs.
+    Returns "done", "up to date" or "skipped"; any error is raised to the caller
+    """
+    folder_name = os.path.basename(folder)
+    print(f"[{folder_name}] Processing...")
+
+    prefix = folder_name.split("_", 1)[0]
+
+    transcripts = glob.glob(os.path.join(folder, "**", "*_TRANSCRIPT.csv"), recursive=True)
+    streams = {}
+    for name, (suffix, _, _) in STREAMS.items():
+        files = glob.glob(os.path.join(folder, "**", f"*{suffix}"), recursive=True)
+        if files:
+            streams[name] = files[0]
+
+    if not transcripts:
+        print(f"[{folder_name}] No *_TRANSCRIPT.csv found, skipping")
+        return "skipped"
+    if "aus" not in streams:
+        print(f"[{folder_name}] No *_CLNF_AUs.txt found, skipping")
+        return "skipped"
+
+    transcript = transcripts[0]
+    if use_subprocess:
+        to_label = {"aus": streams["aus"]}
+    else:
+        to_label = streams
+
+    segments_out = os.path.join(folder, f"{prefix}_speaker_segments.csv")
+
+    status = build_outputs(folder_name, transcript, to_label, segments_out, force, use_subprocess, **labeling)
+
+    # Keep the inputs, the manifest, the AU statistics and every labeled output (also ones written by gaze_label.py)
+    keep_list = [transcript, segments_out, manifest_path(segments_out)] + list(streams.values())
+    keep_list += [str(labeled_path(name, folder, prefix)) for name in STREAMS]
+    keep_list += [str(stats_path(folder, prefix)), str(turns_path(folder, prefix))]
+
+    cleanup_folder_keep_only(folder, keep_paths=keep_list)
+
+    print(f"[{folder_name}] Done. Kept files: {', '.join(os.path.basename(p) for p in keep_list if os.path.exists(p))}")
+    return status
+
+
+def process_archive(zip_path: str, force: bool = False, **labeling) -> str:
+    """
+    Create the speaker segments and the labeled AU, gaze and pose files for one XXX_P.zip archive without
+    extracting it. Only the output files are written, into the participant folder next to the archive.
+    labeling holds the chunksize, policy and label_gaps options of build_outputs.
+    Returns "done", "up to date" or "skipped"; any error is raised to the caller
+    """
+    folder_name = os.path.splitext(os.path.basename(zip_path))[0]
+    print(f"[{folder_name}] Processing {os.path.basename(zip_path)}...")
+
+    transcript = find_member(zip_path, TRANSCRIPT_SUFFIX)
+    streams = {}
+    for name, (suffix, _, _) in STREAMS.items():
+        member = find_member(zip_path, suffix)
+        if member:
+            streams[name] = (zip_path, member)
+
+    if not transcript:
+        print(f"[{folder_name}] No *_TRANSCRIPT.csv in archive, skipping")
+        return "skipped"
+    if "aus" not in streams:
+        print(f"[{folder_name}] No *_CLNF_AUs.txt in archive, skipping")
+        return "skipped"
+
+    folder = os.path.join(BASE_DIR, folder_name)
+    os.makedirs(folder, exist_ok=True)
+
+    prefix = folder_name.split("_", 1)[0]
+    segments_out = os.path.join(folder, f"{prefix}_speaker_segments.csv")
+
+    return build_outputs(folder_name, (zip_path, transcript), streams, segments_out, force, **labeling)
+
 
-    if not folders:
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS,
+                        help="number of participant folders processed in parallel (default: one per CPU core)")
+    parser.add_argument("--subprocess", action="store_true",
+                        help="run ellie_participant_split.py and au_split.py as separate scripts for every folder; "
+                             "only the AU files are labeled (run gaze_label.py for gaze) and no AU statistics files "
+                             "are written for au_aggregation.py --from-stats/--from-turns")
+    parser.add_argument("--from-zip", action="store_true", default=READ_FROM_ZIP,
+                        help="read the input files straight out of the *_P.zip archives instead of extracting them")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild every output, even the ones the manifest reports as up to date")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="label the CLNF files this many frames at a time to keep memory bounded on long sessions")
+    parser.add_argument("--overlap-policy", choices=OVERLAP_POLICIES, default="last",
+                        help="how frames inside overlapping Ellie/Participant turns are labeled")
+    parser.add_argument("--label-gaps", action="store_true",
+                        help="keep frames outside every turn, labeled 'Gap', instead of dropping them")
+    args = parser.parse_args()
+    if args.subprocess and args.from_zip:
+        # au_split.py and ellie_participant_split.py take file paths, not archive members
+        parser.error("--subprocess needs extracted folders; it cannot be combined with --from-zip")
+    if args.subprocess:
+        print("--subprocess labels only the AU files: run gaze_label.py to label gaze. No AU statistics files are "
+              "written, so au_aggregation.py --from-stats/--from-turns reads the frames of these participants")
+
+    labeling = {"chunksize": args.chunksize, "policy": args.overlap_policy, "label_gaps": args.label_gaps}
+
+    # Every task is (function, arguments) and is keyed by the participant folder it writes to
+    tasks = {}
+    if args.from_zip:
+        for zip_path in sorted(glob.glob(os.path.join(BASE_DIR, "*_P.zip"))):
+            tasks[os.path.splitext(zip_path)[0]] = (process_archive, (zip_path, args.force))
+    else:
+        unzip_archives_on_desktop()
+
+    for d in os.listdir(BASE_DIR):
+        folder = os.path.join(BASE_DIR, d)
+        if os.path.isdir(folder) and d.endswith("_P") and folder not in tasks:
+            tasks[folder] = (process_participant, (folder, args.subprocess, args.force))
+
+    if not tasks:
         print("No *_P folders found in:", BASE_DIR)
         return
 
-    for folder in folders:
-        folder_name = os.path.basename(folder)
-        print("\n==============================")
-        print("Processing:", folder_name)
-        print("==============================")
-
-        prefix = folder_name.split("_", 1)[0]
-
-        transcripts = glob.glob(os.path.join(folder, "**", "*_TRANSCRIPT.csv"), recursive=True)
-        aus_files = glob.glob(os.path.join(folder, "**", "*_CLNF_AUs.txt"), recursive=True)
-        gaze_files = glob.glob(os.path.join(folder, "**", "*_CLNF_gaze.txt"), recursive=True)
+    folders = sorted(tasks)
+    workers = args.workers or os.cpu_count() or 1
+    statuses = {}
+    failures = {}
 
-        if not transcripts:
-            print("No *_TRANSCRIPT.csv found, skipping")
-            continue
-        if not aus_files:
-            print("No *_CLNF_AUs.txt found, skipping")
-            continue
-
-        transcript = transcripts[0]
-        aus_file = aus_files[0]
-        gaze_file = gaze_files[0] if gaze_files else None
-
-        segments_out = os.path.join(folder, f"{prefix}_speaker_segments.csv")
-        labeled_out = os.path.join(folder, f"{prefix}_CLNF_AUs_labeled.csv")
-
-        run(["python", SPEAKER_SCRIPT, transcript, "-o", segments_out], cwd=folder)
-        run(["python", AUS_SCRIPT, segments_out, aus_file, "-o", labeled_out], cwd=folder)
-
-        print("Done:", folder_name)
-        print("Kept core files + outputs, now cleaning up...")
-
-        keep_list = [transcript, aus_file, segments_out, labeled_out]
-        if gaze_file:
-            keep_list.append(gaze_file)
-
-        cleanup_folder_keep_only(folder, keep_paths=keep_list)
-
-        print("Final kept files:")
-        print(" -", transcript)
-        print(" -", aus_file)
-        if gaze_file:
-            print(" -", gaze_file)
-        print(" -", segments_out)
-        print(" -", labeled_out)
+    if workers == 1:
+        for folder in folders:
+            func, func_args = tasks[folder]
+            try:
+                statuses[folder] = func(*func_args, **labeling)
+            except Exception as e:
+                print(f"!! [{os.path.basename(folder)}] Failed: {e}")
+                failures[folder] = e
+    else:
+        print(f"Processing {len(folders)} folders with {workers} workers")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for folder in folders:
+                func, func_args = tasks[folder]
+                futures[pool.submit(func, *func_args, **labeling)] = folder
+            for future in as_completed(futures):
+                folder = futures[future]
+                try:
+                    statuses[folder] = future.result()
+                except Exception as e:
+                    print(f"!! [{os.path.basename(folder)}] Failed: {e}")
+                    failures[folder] = e
+
+    done = sum(status == "done" for status in statuses.values())
+    up_to_date = sum(status == "up to date" for status in statuses.values())
+    skipped = sum(status == "skipped" for status in statuses.values())
+    print("\n==============================")
+    print(f"Done: {done}, up to date: {up_to_date}, skipped: {skipped}, failed: {len(failures)}")
+    print("==============================")
+
+    if failures:
+        for folder in sorted(failures):
+            print(" -", os.path.basename(folder), "->", failures[folder])
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
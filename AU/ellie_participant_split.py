@@ -1,38 +1,42 @@
 import argparse
 import os
 import csv
+import io
+import numpy as np
 import pandas as pd
 
 
-def main():
-    # Create the argument parser
-    parser = argparse.ArgumentParser()
-    parser.add_argument("input_csv") # input file (e.g., XXX_TRANSCRIPT.csv)
-    parser.add_argument("-o", "--output", default=None)
-    args = parser.parse_args()
+def sniff_separator(sample: str) -> str:
+    """
+    Return the delimiter (tab, semicolon or comma) of a transcript sample
+    """
+    try:
+        # Try to automatically detect whether the separator is a tab, semicolon, or a comma
+        dialect = csv.Sniffer().sniff(sample, delimiters=["\t", ";", ","])
+        return dialect.delimiter
+    except Exception:
+        return "\t" if "\t" in sample else (";" if ";" in sample else ",")
+
+
+def read_transcript(input_path) -> pd.DataFrame:
+    """
+    Read one XXX_TRANSCRIPT.csv file (a path or a text buffer). The file is read once and the
+    delimiter is sniffed from the first 4000 characters of the text already in memory
+    """
+    if hasattr(input_path, "read"):
+        text = input_path.read()
+    else:
+        with open(input_path, "r", encoding="utf-8", newline="") as f:
+            text = f.read()
+    return pd.read_csv(io.StringIO(text), sep=sniff_separator(text[:4000]))
 
-    input_path = args.input_csv
 
-    # In case we don't provide an output file name it will be XXX_TRANSCRIPT_speakers_segments.csv
-    if args.output is None:
-        base, _ = os.path.splitext(os.path.basename(input_path))
-        out_path = f"{base}_speakers_segments.csv"
-    else:
-        out_path = args.output
-
-    # Open the input file to inspect a small sample and detect the delimiter
-    with open(input_path, "r", encoding="utf-8", newline="") as f:
-        sample = f.read(4000) # Read the first 4000 characters as a sample
-        f.seek(0)
-        try:
-            # Try to automatically detect whether the separator is a tab, semicolon, or a comma
-            dialect = csv.Sniffer().sniff(sample, delimiters=["\t", ";", ","])
-            detected_sep = dialect.delimiter
-        except Exception:
-            detected_sep = "\t" if "\t" in sample else (";" if ";" in sample else ",")
-
-    # Read the CSV file with the detected separator
-    input = pd.read_csv(input_path, sep=detected_sep)
+def build_speaker_segments(input: pd.DataFrame) -> pd.DataFrame:
+    """
+    Merge consecutive transcript rows of the same speaker into one segment.
+    Returns a dataframe with speaker, start_time, stop_time and text columns
+    """
+    input = input.copy()
 
     # Remove spaces in columns names
     input.columns = input.columns.str.strip()
@@ -52,24 +56,74 @@ def main():
     # Sort transcript rows by start_time so consecutive turns are in the right order
     input = input.sort_values("start_time").reset_index(drop=True)
 
-    # Create a group id that increments every time the speaker changes from the previous row
-    # (e.g., Ellie Ellie Ellie Participant Participant Ellie correspond to groups 1 1 1 2 2 3)
-    group_id = (input["speaker"] != input["speaker"].shift()).cumsum()
+    speaker = input["speaker"].to_numpy(dtype=object)
+    if len(speaker) == 0:
+        return pd.DataFrame({"speaker": [], "start_time": [], "stop_time": [], "text": []})
+
+    # A new "run" starts at the first row and every time the speaker changes from the previous row
+    # (e.g., Ellie Ellie Ellie Participant Participant Ellie start runs at rows 0, 3 and 5)
+    run_start = np.flatnonzero(np.r_[True, speaker[1:] != speaker[:-1]])
+    run_stop = np.r_[run_start[1:], len(speaker)] - 1
+
+    # Concatenate all transcript "value" cells of a run. Every non-missing cell contributes " " + value,
+    # so summing the pieces of a run and dropping the first character gives " ".join(values)
+    value = input["value"]
+    pieces = np.where(value.notna(), " " + value.astype(str).str.strip(), "").astype(object)
+    text = np.add.reduceat(pieces, run_start)
+
+    segments = pd.DataFrame({
+        "speaker": speaker[run_start], # speaker name for this "run"
+        "start_time": input["start_time"].to_numpy()[run_start], # first start_time in the "run"
+        "stop_time": input["stop_time"].to_numpy()[run_stop], # last stop_time in the "run"
+        "text": pd.Series(text).str[1:], # concatenation of all transcript "value" cells in that run
+    })
+
+    return segments
 
-    segments = (
-        input.groupby(group_id)
-          .agg(
-              speaker=("speaker", "first"), # speaker name for this "run"
-              start_time=("start_time", "first"), # first start_time in the "run"
-              stop_time=("stop_time", "last"), # last stop_time in the "run"
-              text=("value", lambda x: " ".join(str(s).strip() for s in x if pd.notna(s))) # concatenation of all transcript "value" cells in that run
-          )
-          .reset_index(drop=True)
-    )
 
-    segments.to_csv(out_path, index=False, sep=";")
+def split_transcripts(jobs) -> list:
+    """
+    Build and save the speaker segments of many transcripts in one process.
+    jobs is an iterable of (input_path, out_path) pairs; input_path can be a path or a text buffer.
+    Returns the segments dataframe of every transcript, in the order of jobs
+    """
+    results = []
+    for input_path, out_path in jobs:
+        segments = build_speaker_segments(read_transcript(input_path))
+        segments.to_csv(out_path, index=False, sep=";")
+        results.append(segments)
+    return results
 
-    print(f"Done! Output file name is {out_path}. It contains a total number of segments of {len(segments)}")
+
+def split_transcript(input_path, out_path) -> pd.DataFrame:
+    """
+    Read one XXX_TRANSCRIPT.csv file (a path or a text buffer), build its speaker segments and save them to out_path
+    """
+    return split_transcripts([(input_path, out_path)])[0]
+
+
+def main():
+    # Create the argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_csv", nargs="+") # one or more input files (e.g., XXX_TRANSCRIPT.csv)
+    parser.add_argument("-o", "--output", default=None, help="output file name (only with a single input file)")
+    args = parser.parse_args()
+
+    if args.output is not None and len(args.input_csv) > 1:
+        parser.error("-o/--output can only be used with a single input file")
+
+    # In case we don't provide an output file name it will be XXX_TRANSCRIPT_speakers_segments.csv
+    jobs = []
+    for input_path in args.input_csv:
+        if args.output is None:
+            base, _ = os.path.splitext(os.path.basename(input_path))
+            out_path = f"{base}_speakers_segments.csv"
+        else:
+            out_path = args.output
+        jobs.append((input_path, out_path))
+
+    for (_, out_path), segments in zip(jobs, split_transcripts(jobs)):
+        print(f"Done! Output file name is {out_path}. It contains a total number of segments of {len(segments)}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
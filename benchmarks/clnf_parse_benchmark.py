@@ -0,0 +1,123 @@
+"""
+Compare the old string based CLNF loading with common.clnf_io.read_clnf.
+
+Every parser runs in a fresh process so the peak RSS of one does not hide the next one.
+Without a file argument, a synthetic full-length session (OpenFace AU layout) is generated.
+
+    python benchmarks/clnf_parse_benchmark.py [XXX_CLNF_AUs.txt] [--minutes 30] [--repeat 3]
+"""
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT_DIR)
+
+AU_R = ["AU01_r", "AU02_r", "AU04_r", "AU05_r", "AU06_r", "AU09_r", "AU10_r",
+        "AU12_r", "AU14_r", "AU15_r", "AU17_r", "AU20_r", "AU25_r", "AU26_r"]
+AU_C = ["AU04_c", "AU12_c", "AU15_c", "AU23_c", "AU28_c", "AU45_c"]
+FPS = 30
+
+
+def write_synthetic_session(path, minutes):
+    """Write an OpenFace style AU file with `minutes` of frames at 30 fps"""
+    rng = np.random.default_rng(0)
+    n = int(minutes * 60 * FPS)
+    frame = np.arange(1, n + 1)
+    timestamp = (frame - 1) / FPS
+    confidence = rng.uniform(0.5, 1.0, n)
+    success = (rng.uniform(size=n) > 0.05).astype(int)
+    au_r = rng.uniform(0, 5, (n, len(AU_R)))
+    au_c = rng.integers(0, 2, (n, len(AU_C)))
+
+    with open(path, "w") as f:
+        f.write(", ".join(["frame", "timestamp", "confidence", "success"] + AU_R + AU_C) + "\n")
+        for i in range(n):
+            values = [str(frame[i]), f"{timestamp[i]:.7g}", f"{confidence[i]:.6f}", str(success[i])]
+            values += [f"{v:.6f}" for v in au_r[i]] + [f"{v:.6f}" for v in au_c[i]]
+            f.write(", ".join(values) + "\n")
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _legacy(path):
+    import pandas as pd
+    df = pd.read_csv(path, sep=",", engine="python", dtype=str)
+    df.columns = df.columns.str.strip()
+    df["timestamp_num"] = pd.to_numeric(df["timestamp"].astype(str).str.strip(), errors="coerce")
+    return df
+
+
+def _typed(engine):
+    def parse(path):
+        from common.clnf_io import read_clnf
+        return read_clnf(path, projection="aus", engine=engine)
+    return parse
+
+
+PARSERS = {
+    "legacy (python engine, dtype=str)": _legacy,
+    "read_clnf (c engine)": _typed("c"),
+    "read_clnf (pyarrow engine)": _typed("pyarrow"),
+}
+
+
+def _run(name, path, queue):
+    import pandas  # noqa: F401  (import cost is not part of the measurement)
+    parse = PARSERS[name]
+    before = _peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        df = parse(path)
+    except ImportError as e:
+        queue.put((name, None, None, None, str(e)))
+        return
+    elapsed = time.perf_counter() - start
+    queue.put((name, elapsed, _peak_rss_mb() - before, int(df.memory_usage(deep=True).sum()) / 1e6, None))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("clnf_txt", nargs="?", default=None)
+    parser.add_argument("--minutes", type=float, default=30, help="length of the synthetic session")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.clnf_txt
+        if path is None:
+            path = os.path.join(tmp, "synthetic_CLNF_AUs.txt")
+            print(f"Writing a synthetic {args.minutes:g} minute session...")
+            write_synthetic_session(path, args.minutes)
+        print(f"File: {path} ({os.path.getsize(path) / 1e6:.1f} MB)\n")
+
+        ctx = mp.get_context("spawn")
+        print(f"{'parser':<36}{'best time (s)':>14}{'peak RSS (MB)':>15}{'frame (MB)':>12}")
+        for name in PARSERS:
+            results = []
+            for _ in range(args.repeat):
+                queue = ctx.Queue()
+                p = ctx.Process(target=_run, args=(name, path, queue))
+                p.start()
+                results.append(queue.get())
+                p.join()
+            if results[0][4]:
+                print(f"{name:<36}  skipped: {results[0][4]}")
+                continue
+            best = min(r[1] for r in results)
+            peak = max(r[2] for r in results)
+            print(f"{name:<36}{best:>14.3f}{peak:>15.1f}{results[0][3]:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
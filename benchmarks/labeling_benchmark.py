@@ -0,0 +1,122 @@
+"""
+Time the original label_timestamps_with_segments against the interval-index labeler and its overlap policies
+on a long synthetic session with overlapping Ellie/Participant turns.
+
+    python benchmarks/labeling_benchmark.py [--hours 3] [--overlap 0.3] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT_DIR)
+
+from common.segment_labeler import OVERLAP_POLICIES, SegmentIndex
+
+FPS = 30
+
+
+def original_label_timestamps_with_segments(au_df: pd.DataFrame, segments_df: pd.DataFrame) -> pd.DataFrame:
+    """The labeler as it was in au_split.py / gaze_label.py before the shared engine, for reference"""
+    au_df = au_df.copy()
+    segments_df = segments_df.copy()
+    au_df.columns = au_df.columns.str.strip()
+    segments_df.columns = segments_df.columns.str.strip()
+
+    au_df["timestamp_raw"] = au_df["timestamp"].astype(str)
+    au_df["timestamp_num"] = pd.to_numeric(au_df["timestamp_raw"].str.strip(), errors="coerce")
+    segments_df["start_time"] = pd.to_numeric(segments_df["start_time"], errors="coerce")
+    segments_df["stop_time"] = pd.to_numeric(segments_df["stop_time"], errors="coerce")
+    au_df = au_df.dropna(subset=["timestamp_num"]).copy()
+    segments_df = segments_df.dropna(subset=["speaker", "start_time", "stop_time"]).copy()
+    segments_df = segments_df.sort_values("start_time").reset_index(drop=True)
+
+    starts = segments_df["start_time"].to_numpy()
+    stops = segments_df["stop_time"].to_numpy()
+    speakers = segments_df["speaker"].astype(str).to_numpy()
+
+    timestamp = au_df["timestamp_num"].to_numpy()
+    idx = np.searchsorted(starts, timestamp, side="right") - 1
+    idx_clip = np.clip(idx, 0, len(stops) - 1)
+    valid_timestamp = (idx >= 0) & (timestamp <= stops[idx_clip])
+
+    out = au_df.loc[valid_timestamp].copy()
+    out.insert(0, "speaker", speakers[idx[valid_timestamp]])
+    out["speaker"] = out["speaker"].replace({"Ellie": "Listening", "Participant": "Speaking"})
+    out["timestamp"] = out["timestamp_raw"]
+    return out.drop(columns=["timestamp_raw", "timestamp_num"])
+
+
+def synthetic_session(hours, overlap, seed=0):
+    """Alternating turns where a fraction `overlap` of them starts before the previous turn has ended"""
+    rng = np.random.default_rng(seed)
+    duration = hours * 3600
+    rows, t, speaker = [], 1.0, "Ellie"
+    while t < duration:
+        length = rng.uniform(1, 8)
+        rows.append((speaker, t, t + length))
+        if rng.uniform() < overlap:
+            t += length * rng.uniform(0.3, 0.9) # next turn starts inside this one
+        else:
+            t += length + rng.uniform(0, 1.5)
+        speaker = "Participant" if speaker == "Ellie" else "Ellie"
+    segments = pd.DataFrame(rows, columns=["speaker", "start_time", "stop_time"])
+
+    n = int(duration * FPS)
+    frames = pd.DataFrame({
+        "frame": np.arange(1, n + 1, dtype=np.int32),
+        "timestamp": np.arange(n) / FPS,
+        "confidence": rng.uniform(0.5, 1, n),
+        "success": np.ones(n, dtype=np.int8),
+    })
+    for i in range(14):
+        frames[f"AU{i:02d}_r"] = rng.uniform(0, 5, n).astype(np.float32)
+    return segments, frames
+
+
+def best_time(func, repeat):
+    best, result = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, default=3)
+    parser.add_argument("--overlap", type=float, default=0.3, help="fraction of turns that overlap the next one")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    segments, frames = synthetic_session(args.hours, args.overlap)
+    print(f"{len(frames)} frames, {len(segments)} segments, {args.overlap:.0%} overlapping turns\n")
+
+    covered = None
+    print(f"{'labeler':<34}{'best time (s)':>14}{'rows':>10}{'frames':>10}")
+
+    runs = [("original (copy-pasted)", lambda: original_label_timestamps_with_segments(frames, segments))]
+    index_build, _ = best_time(lambda: SegmentIndex(segments), args.repeat)
+    for policy in OVERLAP_POLICIES:
+        index = SegmentIndex(segments, policy=policy)
+        runs.append((f"SegmentIndex policy={policy}", lambda index=index: index.label(frames)))
+
+    for name, func in runs:
+        elapsed, out = best_time(func, args.repeat)
+        n_frames = out["frame"].nunique()
+        if name.endswith("first"):
+            covered = n_frames
+        print(f"{name:<34}{elapsed:>14.3f}{len(out):>10}{n_frames:>10}")
+
+    print(f"\nBuilding the index once: {index_build * 1000:.1f} ms")
+    original = original_label_timestamps_with_segments(frames, segments)["frame"].nunique()
+    print(f"Covered frames the original labeler drops: {covered - original} of {covered}")
+
+
+if __name__ == "__main__":
+    main()
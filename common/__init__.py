@@ -0,0 +1 @@
+"""Helpers shared by the AU and gaze pipelines."""
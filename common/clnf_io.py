@@ -0,0 +1,131 @@
+import re
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from common.participant_archive import open_member
+
+# Per frame bookkeeping columns that every OpenFace CLNF file starts with
+META_COLUMNS = ["frame", "timestamp", "confidence", "success"]
+
+# Known schema: integer bookkeeping columns, float64 where exact comparisons matter
+# (segment boundaries for timestamp, CONF_THRESH for confidence), float32 for every feature column
+META_DTYPES = {
+    "frame": np.int32,
+    "timestamp": np.float64,
+    "confidence": np.float64,
+    "success": np.int8,
+}
+FEATURE_DTYPE = np.float32
+
+AU_COLUMN = re.compile(r"^AU\d+_[rc]$")
+GAZE_COLUMN = re.compile(r"^[xyz]_h?\d+$")
+
+# Column selections understood by read_clnf
+PROJECTIONS = {
+    "aus": lambda c: bool(AU_COLUMN.match(c)),
+    "gaze": lambda c: bool(GAZE_COLUMN.match(c)),
+    "all": lambda c: True,
+}
+
+
+def _read_header(f) -> list:
+    """Read the header line of an open CLNF file and return its column names without surrounding spaces"""
+    line = f.readline()
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    return [c.strip() for c in line.rstrip("\r\n").split(",")]
+
+
+@contextmanager
+def _open_source(source):
+    """Open a path, an already open file or a (zip_path, member) tuple for reading"""
+    if hasattr(source, "read"):
+        yield source
+    elif isinstance(source, tuple):
+        with open_member(*source) as f:
+            yield f
+    else:
+        with open(source, "rb") as f:
+            yield f
+
+
+def select_columns(columns, projection="all") -> list:
+    """
+    Columns of a CLNF file to load: the bookkeeping columns plus the features picked by projection,
+    which is "aus" (AU*_r and AU*_c), "gaze" (x_0 ... z_h1), "all", or a function taking a column name
+    """
+    keep = PROJECTIONS[projection] if isinstance(projection, str) else projection
+    return [c for c in columns if c and (c in META_COLUMNS or keep(c))]
+
+
+def read_clnf(source, projection="all", engine="c") -> pd.DataFrame:
+    """
+    Read an OpenFace CLNF .txt file (a path, an open file or a (zip_path, member) tuple) into typed columns.
+    Header names are stripped, only the projected columns are parsed and values are stored with the
+    META_DTYPES / FEATURE_DTYPE schema instead of as strings. engine is "c" or "pyarrow"
+    """
+    with _open_source(source) as f:
+        names = _read_header(f)
+        usecols = select_columns(names, projection)
+        dtypes = {c: META_DTYPES.get(c, FEATURE_DTYPE) for c in usecols}
+
+        if engine == "pyarrow":
+            df = _read_with_pyarrow(f, names, usecols, dtypes)
+        else:
+            df = pd.read_csv(
+                f,
+                header=None,
+                names=names,
+                usecols=usecols,
+                dtype=dtypes,
+                skipinitialspace=True,
+                engine=engine,
+            )
+
+    return df[usecols]
+
+
+def read_clnf_chunks(source, projection="all", chunksize=100_000):
+    """
+    Same as read_clnf, but yields the file in typed chunks of at most chunksize frames,
+    so memory stays bounded however long the session is
+    """
+    with _open_source(source) as f:
+        names = _read_header(f)
+        usecols = select_columns(names, projection)
+        dtypes = {c: META_DTYPES.get(c, FEATURE_DTYPE) for c in usecols}
+
+        reader = pd.read_csv(
+            f,
+            header=None,
+            names=names,
+            usecols=usecols,
+            dtype=dtypes,
+            skipinitialspace=True,
+            chunksize=chunksize,
+        )
+        with reader:
+            for chunk in reader:
+                yield chunk[usecols]
+
+
+def _read_with_pyarrow(f, names, usecols, dtypes) -> pd.DataFrame:
+    """Multi-threaded parse with pyarrow.csv, which is an optional dependency"""
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError as e:
+        raise ImportError("engine='pyarrow' needs the pyarrow package (pip install pyarrow)") from e
+
+    table = pa_csv.read_csv(
+        f,
+        read_options=pa_csv.ReadOptions(column_names=names),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=usecols,
+            column_types={c: pa.from_numpy_dtype(np.dtype(t)) for c, t in dtypes.items()},
+            null_values=["", "nan", "NaN", "-nan", "-1.#IND", "1.#IND", "-1.#QNAN", "1.#QNAN"],
+        ),
+    )
+    return table.to_pandas()
@@ -0,0 +1,226 @@
+import operator
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Storage format of the frame level tables (labeled frames, cleaned gaze frames, gaze deltas).
+# "csv" keeps the original text files; "parquet" stores every table as a dataset partitioned by participant
+FRAME_FORMAT = "csv"
+
+ROOT_DIR = Path(__file__).parent.resolve().parent # BachelorProject
+FRAMES_DIR = ROOT_DIR / "data" / "frames" # BachelorProject/data/frames
+
+PARTITION_COL = "person_id"
+
+_OPS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("FRAME_FORMAT='parquet' needs the pyarrow package (pip install pyarrow)") from e
+    return pq
+
+
+def dataset_dir(dataset) -> Path:
+    """Folder of a partitioned dataset, e.g. data/frames/CLNF_gaze_labeled"""
+    return FRAMES_DIR / dataset
+
+
+def participant_path(dataset, person_id) -> Path:
+    """Parquet file that holds one participant's partition of a dataset"""
+    return dataset_dir(dataset) / f"{PARTITION_COL}={person_id}" / "part-0.parquet"
+
+
+def list_partitions(dataset) -> dict:
+    """Map every participant ID stored in a dataset to its partition file"""
+    out = {}
+    for path in sorted(dataset_dir(dataset).glob(f"{PARTITION_COL}=*/part-0.parquet")):
+        out[path.parent.name.split("=", 1)[1]] = path
+    return out
+
+
+def write_frames(df: pd.DataFrame, path, **csv_kwargs):
+    """Write a frame table to a .csv or .parquet file, picked by the file extension"""
+    path = Path(path)
+    if path.suffix == ".parquet":
+        _require_pyarrow()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # In a partition the participant ID is stored in the folder name, not in the file
+        df.drop(columns=[PARTITION_COL], errors="ignore").to_parquet(path, index=False)
+    else:
+        df.to_csv(path, **csv_kwargs)
+
+
+class FrameWriter:
+    """
+    Append frame tables chunk by chunk to one .csv or .parquet file, picked by the file extension.
+    The csv header is written with the first chunk; parquet chunks become row groups of one file
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._parquet = self.path.suffix == ".parquet"
+        self._writer = None
+        self._started = False
+
+    def write(self, df: pd.DataFrame):
+        if self._parquet:
+            import pyarrow as pa
+            pq = _require_pyarrow()
+            table = pa.Table.from_pandas(df.drop(columns=[PARTITION_COL], errors="ignore"), preserve_index=False)
+            if self._writer is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode="a" if self._started else "w", header=not self._started, index=False)
+        self._started = True
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def clear_dataset(dataset):
+    """Remove every partition of a dataset"""
+    out_dir = dataset_dir(dataset)
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+
+
+def write_partitioned(df: pd.DataFrame, dataset):
+    """Replace a dataset with df, one parquet file per participant"""
+    _require_pyarrow()
+    if PARTITION_COL not in df.columns:
+        df = df.reset_index()
+
+    clear_dataset(dataset)
+
+    for person_id, part in df.groupby(PARTITION_COL, sort=False, observed=True):
+        write_frames(part, participant_path(dataset, person_id))
+
+
+class DatasetWriter:
+    """
+    Write a table a few participants at a time instead of all at once: appended to a csv file or, with
+    FRAME_FORMAT = "parquet", as the partitioned dataset named after the file (one partition per participant).
+    The table must have a person_id column (or index). The old file or dataset is replaced on the first write
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._csv = None
+        self._cleared = False
+
+    def write(self, df: pd.DataFrame):
+        if PARTITION_COL not in df.columns:
+            df = df.reset_index()
+        if FRAME_FORMAT == "parquet":
+            _require_pyarrow()
+            if not self._cleared:
+                clear_dataset(self.path.stem)
+                self._cleared = True
+            for person_id, part in df.groupby(PARTITION_COL, sort=False, observed=True):
+                write_frames(part, participant_path(self.path.stem, person_id))
+        else:
+            if self._csv is None:
+                self._csv = FrameWriter(self.path)
+            self._csv.write(df)
+
+    def close(self):
+        if self._csv is not None:
+            self._csv.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _resolve_columns(columns, available):
+    """columns is None (all), a list of names or a function that picks names"""
+    if columns is None:
+        return None
+    if callable(columns):
+        return [c for c in available if columns(c)]
+    return [c for c in columns if c in available]
+
+
+def filter_mask(df: pd.DataFrame, filters) -> np.ndarray:
+    """Boolean mask of the rows that pass every (column, op, value) filter, skipping columns the table does not have"""
+    mask = np.ones(len(df), dtype=bool)
+    for col, op, value in filters or []:
+        if col in df.columns:
+            mask &= _OPS[op](df[col], value).to_numpy(dtype=bool)
+    return mask
+
+
+def _apply_filters(df: pd.DataFrame, filters) -> pd.DataFrame:
+    """Apply (column, op, value) filters in pandas"""
+    return df[filter_mask(df, filters)]
+
+
+def read_frames(path, columns=None, filters=None) -> pd.DataFrame:
+    """
+    Read one frame table with column projection and row filters.
+    filters is a list of (column, op, value) tuples that are all required to hold. For parquet files
+    they are pushed down to the reader, so row groups that cannot match are never decoded
+    """
+    path = Path(path)
+    if path.suffix == ".parquet":
+        pq = _require_pyarrow()
+        schema = pq.read_schema(path)
+        available = set(schema.names)
+        filters = [f for f in filters or [] if f[0] in available] or None
+        table = pq.read_table(path, columns=_resolve_columns(columns, schema.names), filters=filters)
+        return table.to_pandas()
+
+    if callable(columns):
+        usecols = lambda c: columns(c.strip())
+    else:
+        usecols = columns
+    df = pd.read_csv(path, usecols=usecols)
+    df.columns = df.columns.str.strip()
+    return _apply_filters(df, filters)
+
+
+def read_dataset(dataset, columns=None, filters=None) -> pd.DataFrame:
+    """
+    Read a partitioned dataset into one dataframe, with the participant ID restored as a column.
+    Filters on person_id only open the matching partitions
+    """
+    pq = _require_pyarrow()
+    partitions = list_partitions(dataset)
+    if not partitions:
+        raise FileNotFoundError(f"No partitions found in {dataset_dir(dataset)}")
+
+    schema = pq.read_schema(next(iter(partitions.values())))
+    cols = _resolve_columns(columns, schema.names)
+    if cols is not None:
+        cols = cols + [PARTITION_COL]
+
+    table = pq.read_table(dataset_dir(dataset), columns=cols, filters=filters or None, partitioning="hive")
+    df = table.to_pandas()
+
+    # Hive partition keys come back as a categorical; turn them back into plain values
+    if PARTITION_COL in df.columns and isinstance(df[PARTITION_COL].dtype, pd.CategoricalDtype):
+        df[PARTITION_COL] = df[PARTITION_COL].astype(df[PARTITION_COL].cat.categories.dtype)
+    return df
@@ -0,0 +1,28 @@
+from pathlib import Path
+
+import pandas as pd
+
+
+def read_existing(path, columns) -> pd.DataFrame:
+    """An aggregation file written by an earlier run, or an empty table with its columns if there is none"""
+    path = Path(path)
+    if not path.exists():
+        return pd.DataFrame(columns=columns)
+    # Round trip parsing, so the rows that are taken over are written back exactly as they were
+    return pd.read_csv(path, float_precision="round_trip")
+
+
+def merge_participants(existing: pd.DataFrame, new: pd.DataFrame, replaced, keys, sort_by) -> pd.DataFrame:
+    """
+    Merge freshly aggregated participants into the rows of an earlier run. Every earlier row of a replaced
+    participant is dropped first (so a segment a participant no longer has goes away as well), then the new
+    rows are added and each key (e.g. person_id/segment_type/AU/stat) is kept once, the new row winning.
+    The result is sorted by sort_by with a stable sort, so each participant keeps its own row order
+    """
+    replaced = {str(p) for p in replaced}
+    existing = existing[~existing["person_id"].astype(str).isin(replaced)]
+    parts = [p for p in (existing, new) if not p.empty]
+    if not parts:
+        return existing.iloc[:0]
+    merged = pd.concat(parts, ignore_index=True).drop_duplicates(keys, keep="last")
+    return merged.sort_values(sort_by, kind="stable", ignore_index=True)
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import zipfile
+
+# Files are hashed in blocks of this many bytes
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def code_version(*source_files) -> str:
+    """Short hash of the source files that produce an output; any edit to them changes the version"""
+    h = hashlib.sha256()
+    for path in source_files:
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def _sha256(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_fingerprint(path, previous=None) -> dict:
+    """
+    Size, modification time and content hash of a file.
+    If previous (the fingerprint recorded last time) has the same size and modification time,
+    its hash is reused so unchanged files are not read again
+    """
+    st = os.stat(path)
+    fingerprint = {"name": os.path.basename(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    if previous and all(previous.get(k) == fingerprint[k] for k in ("size", "mtime_ns")) and "sha256" in previous:
+        fingerprint["sha256"] = previous["sha256"]
+    else:
+        fingerprint["sha256"] = _sha256(path)
+
+    return fingerprint
+
+
+def member_fingerprint(zip_path, member) -> dict:
+    """Size, modification time and CRC32 of an archive member, read from the archive index without decompressing"""
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        info = zf.getinfo(member)
+    return {
+        "name": os.path.basename(member),
+        "size": info.file_size,
+        "date_time": list(info.date_time),
+        "crc32": info.CRC,
+    }
+
+
+def _same_content(old: dict, new: dict) -> bool:
+    """Compare two fingerprints on content only, so a touched but unchanged file still counts as the same"""
+    key = "sha256" if "sha256" in new else "crc32"
+    return old.get("name") == new.get("name") and old.get("size") == new.get("size") and old.get(key) == new.get(key)
+
+
+class Manifest:
+    """
+    Per participant folder record of which inputs and which code version produced each output file.
+    Outputs are keyed by their path relative to the manifest (the file name for outputs in the same folder);
+    every entry holds the code version and a fingerprint per named input
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                # A damaged manifest only means everything in the folder is rebuilt once
+                self.entries = {}
+
+    def _key(self, output) -> str:
+        return os.path.relpath(output, os.path.dirname(os.path.abspath(self.path)))
+
+    def fingerprints(self, output, sources: dict) -> dict:
+        """
+        Fingerprint the inputs of an output. sources maps an input name to a file path
+        or to a (zip_path, member) tuple for a file inside a participant archive
+        """
+        previous = self.entries.get(self._key(output), {}).get("inputs", {})
+        out = {}
+        for name, source in sources.items():
+            if isinstance(source, tuple):
+                out[name] = member_fingerprint(*source)
+            else:
+                out[name] = file_fingerprint(source, previous.get(name))
+        return out
+
+    def is_up_to_date(self, output, inputs: dict, version: str) -> bool:
+        """True if output exists and was produced by the same code version from inputs with the same content"""
+        entry = self.entries.get(self._key(output))
+        if entry is None or not os.path.exists(output):
+            return False
+        if entry.get("code_version") != version or set(entry.get("inputs", {})) != set(inputs):
+            return False
+        return all(_same_content(entry["inputs"][name], fp) for name, fp in inputs.items())
+
+    def changed_inputs(self, output, inputs: dict, version: str):
+        """
+        Which inputs of output changed since it was recorded: returns (changed, removed), the names of the inputs
+        that are new or have other content and the names of the recorded inputs that are gone.
+        Returns None if output has to be rebuilt from every input (missing, not recorded or another code version)
+        """
+        entry = self.entries.get(self._key(output))
+        if entry is None or not os.path.exists(output) or entry.get("code_version") != version:
+            return None
+        old = entry.get("inputs", {})
+        changed = {name for name, fp in inputs.items() if name not in old or not _same_content(old[name], fp)}
+        return changed, set(old) - set(inputs)
+
+    def record(self, output, inputs: dict, version: str):
+        self.entries[self._key(output)] = {"code_version": version, "inputs": inputs}
+
+    def forget(self, output):
+        """Drop the record of output, e.g. after it was written in a way the manifest does not track"""
+        self.entries.pop(self._key(output), None)
+
+    def save(self):
+        # Write to a temporary file first so an interrupted run never leaves a half written manifest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
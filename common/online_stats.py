@@ -0,0 +1,216 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from common.frame_store import filter_mask
+from common.manifest import code_version
+from common.segment_labeler import infer_masks
+
+# Version of the statistics code; part of the manifest version of every statistics file
+STATS_VERSION = code_version(__file__)
+
+# Segments the statistics are kept for, in the order au_aggregation.py writes them.
+# "all" holds every kept frame, the others the frames labeled with that interaction type
+SEGMENTS = ("all", "speaking", "listening")
+
+# Columns of a saved statistics table
+STATS_COLUMNS = ["segment_type", "column", "count", "mean", "m2", "min", "max"]
+
+
+class RunningStats:
+    """
+    Count, mean, sum of squared deviations (M2), min and max of a set of columns, per group.
+    Values are added a chunk at a time: the chunk's own count/mean/M2 are computed with NumPy and merged
+    into the running values with Chan's parallel form of Welford's update, so the result does not depend
+    on how the frames were chunked and never needs the frames again. Missing values are skipped
+    """
+
+    def __init__(self, columns, groups=()):
+        self.columns = list(columns)
+        self._stats = {}
+        for group in groups:
+            self._group(group)
+
+    def _group(self, group) -> dict:
+        if group not in self._stats:
+            n = len(self.columns)
+            self._stats[group] = {
+                "count": np.zeros(n),
+                "mean": np.zeros(n),
+                "m2": np.zeros(n),
+                "min": np.full(n, np.nan),
+                "max": np.full(n, np.nan),
+            }
+        return self._stats[group]
+
+    @property
+    def groups(self) -> list:
+        return list(self._stats)
+
+    def update(self, group, values):
+        """Add a (frames x columns) array of values to a group"""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        missing = np.isnan(values)
+        if missing.any():
+            count = (~missing).sum(axis=0).astype(np.float64)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = np.where(missing, 0.0, values).sum(axis=0) / count
+            m2 = np.where(missing, 0.0, (values - mean) ** 2).sum(axis=0)
+            mean = np.where(count > 0, mean, 0.0)
+        else:
+            count = np.full(values.shape[1], float(len(values)))
+            mean = values.mean(axis=0)
+            m2 = ((values - mean) ** 2).sum(axis=0)
+        # fmin/fmax ignore NaN, so columns without any value keep NaN
+        self._merge(group, count, mean, m2, np.fmin.reduce(values, axis=0), np.fmax.reduce(values, axis=0))
+
+    def _merge(self, group, count, mean, m2, vmin, vmax):
+        s = self._group(group)
+        total = s["count"] + count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = mean - s["mean"]
+            # An empty group takes the added mean as is, so copying statistics does not round them
+            s["mean"] = np.where(total > 0, np.where(s["count"] > 0, s["mean"] + delta * count / total, mean), 0.0)
+            s["m2"] = np.where(total > 0, s["m2"] + m2 + delta ** 2 * s["count"] * count / total, 0.0)
+        s["count"] = total
+        s["min"] = np.fmin(s["min"], vmin)
+        s["max"] = np.fmax(s["max"], vmax)
+
+    def merge(self, other: "RunningStats", group, into=None):
+        """Add a group of another RunningStats over the same columns to group into (default: the same group)"""
+        if other.columns != self.columns:
+            raise ValueError("Cannot merge statistics over different columns")
+        s = other._stats[group]
+        self._merge(group if into is None else into, s["count"], s["mean"], s["m2"], s["min"], s["max"])
+
+    def mean(self, group) -> np.ndarray:
+        s = self._stats[group]
+        return np.where(s["count"] > 0, s["mean"], np.nan)
+
+    def std(self, group, ddof=0) -> np.ndarray:
+        s = self._stats[group]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(s["count"] > ddof, np.sqrt(s["m2"] / (s["count"] - ddof)), np.nan)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Long table with one row per group and column (STATS_COLUMNS)"""
+        parts = []
+        for group, s in self._stats.items():
+            parts.append(pd.DataFrame({
+                "segment_type": group,
+                "column": self.columns,
+                "count": s["count"].astype(np.int64),
+                "mean": s["mean"],
+                "m2": s["m2"],
+                "min": s["min"],
+                "max": s["max"],
+            }, columns=STATS_COLUMNS))
+        if not parts:
+            return pd.DataFrame(columns=STATS_COLUMNS)
+        return pd.concat(parts, ignore_index=True)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "RunningStats":
+        """Inverse of to_frame"""
+        columns = list(dict.fromkeys(df["column"]))
+        stats = cls(columns)
+        for group, part in df.groupby("segment_type", sort=False):
+            part = part.set_index("column").reindex(columns)
+            s = stats._group(group)
+            s["count"] = part["count"].fillna(0).to_numpy(dtype=np.float64)
+            for key in ("mean", "m2", "min", "max"):
+                s[key] = part[key].to_numpy(dtype=np.float64)
+        return stats
+
+    def save(self, path):
+        self.to_frame().to_csv(path, index=False)
+
+    @classmethod
+    def load(cls, path) -> "RunningStats":
+        return cls.from_frame(pd.read_csv(path))
+
+
+class SegmentStats:
+    """
+    Running statistics of labeled frames per segment type (SEGMENTS), updated while the frames are labeled.
+    columns picks the feature columns (a list or a function of the column name); filters are the
+    (column, op, value) frame filters of the aggregation (e.g. success == 1, confidence >= 0.7) and are
+    applied to every chunk before it is added.
+    Frames are kept per speaker value; which values make up speaking and listening is decided by
+    infer_masks once every frame is in, since (like au_aggregation.py) a session with a single role
+    counts every other frame as the other role
+    """
+
+    def __init__(self, columns, filters=None):
+        self._select = columns
+        self.filters = list(filters or [])
+        self.stats = None
+        self.by_speaker = None
+        # Number of kept frames per speaker value (None for a missing speaker)
+        self.frames = {}
+
+    def update(self, labeled: pd.DataFrame, turns=None):
+        if self.stats is None:
+            if callable(self._select):
+                columns = [c for c in labeled.columns if self._select(c)]
+            else:
+                columns = [c for c in self._select if c in labeled.columns]
+            self.stats = RunningStats(columns)
+            self.by_speaker = RunningStats(columns)
+        if len(labeled) == 0:
+            return
+
+        keep = filter_mask(labeled, self.filters)
+        values = labeled[self.stats.columns].to_numpy(dtype=np.float64)[keep]
+        codes, speakers = pd.factorize(labeled["speaker"].to_numpy()[keep], use_na_sentinel=False)
+
+        self.stats.update("all", values)
+        for i, speaker in enumerate(speakers):
+            key = None if pd.isna(speaker) else speaker
+            rows = codes == i
+            self.by_speaker.update(key, values[rows])
+            self.frames[key] = self.frames.get(key, 0) + int(rows.sum())
+
+    def segment_stats(self) -> RunningStats:
+        """The "all" statistics plus the speaking/listening statistics merged from the speaker values infer_masks assigns"""
+        out = RunningStats(self.stats.columns)
+        out.merge(self.stats, "all")
+        if not self.frames:
+            return out
+
+        speakers = list(self.frames)
+        counts = [self.frames[s] for s in speakers]
+        # One row per kept frame, so infer_masks weighs the speaker values as it does for the frames themselves
+        frames = pd.DataFrame({"speaker": pd.Series(speakers, dtype=object).repeat(counts).reset_index(drop=True)})
+        try:
+            masks = infer_masks(frames)
+        except RuntimeError:
+            # No role at all: only "all" (au_aggregation.py cannot aggregate such a session either)
+            return out
+        first_frame = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        for segment in ("speaking", "listening"):
+            if segment in masks:
+                for speaker, member in zip(speakers, masks[segment].to_numpy()[first_frame]):
+                    if member:
+                        out.merge(self.by_speaker, speaker, into=segment)
+        return out
+
+    def to_frame(self) -> pd.DataFrame:
+        """Statistics of every segment that has frames, in SEGMENTS order"""
+        if self.stats is None:
+            return pd.DataFrame(columns=STATS_COLUMNS)
+        df = self.segment_stats().to_frame()
+        # A segment without any frame is left out, as au_aggregation.py does
+        counts = df.groupby("segment_type", sort=False)["count"].max()
+        present = [s for s in SEGMENTS if counts.get(s, 0) > 0]
+        if not present:
+            return pd.DataFrame(columns=STATS_COLUMNS)
+        return pd.concat([df[df["segment_type"] == s] for s in present], ignore_index=True)
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.to_frame().to_csv(path, index=False)
@@ -0,0 +1,42 @@
+import io
+import os
+import zipfile
+from contextlib import contextmanager
+
+# File name endings of the archive members the pipelines actually read
+TRANSCRIPT_SUFFIX = "_TRANSCRIPT.csv"
+AUS_SUFFIX = "_CLNF_AUs.txt"
+GAZE_SUFFIX = "_CLNF_gaze.txt"
+
+
+def find_member(zip_path, suffix):
+    """
+    Return the name of the first archive member whose file name ends with suffix, or None.
+    Members can sit in a nested folder inside the archive; macOS metadata entries are ignored
+    """
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        names = sorted(
+            n for n in zf.namelist()
+            if not n.endswith("/") and not n.startswith("__MACOSX/") and os.path.basename(n).endswith(suffix)
+        )
+    return names[0] if names else None
+
+
+@contextmanager
+def open_member(zip_path, member):
+    """Open an archive member as a binary stream that is decompressed while it is being read"""
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        with zf.open(member, "r") as f:
+            yield f
+
+
+def read_member_text(zip_path, member, encoding="utf-8") -> io.StringIO:
+    """Read a (small) text member completely and return it as an in-memory text buffer"""
+    with open_member(zip_path, member) as f:
+        return io.StringIO(f.read().decode(encoding), newline="")
+
+
+def archive_for_folder(folder):
+    """Return the XXX_P.zip archive that belongs to a participant folder, or None if there is none"""
+    zip_path = f"{os.path.normpath(folder)}.zip"
+    return zip_path if os.path.isfile(zip_path) else None
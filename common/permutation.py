@@ -0,0 +1,328 @@
+import hashlib
+import json
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+
+# Permutations evaluated per batch; a batch holds a (permutations x rows) matrix of labels.
+# Every block draws from its own random stream, so changing the block size changes the draws
+BLOCK_SIZE = 250
+# Cached null distributions are evicted, least recently used first, above this many megabytes
+CACHE_MAX_MB = 500
+# Adaptive runs stop once the p-value is this many Monte Carlo standard errors away from the threshold
+SETTLED_Z = 2.576
+
+
+class InteractionDesign:
+    """
+    The model value ~ depressed * segment_type (treatment coding, first segment type as reference) for one
+    outcome, set up once so the t statistic of the depressed:segment_type interaction can be computed for
+    thousands of subject level shuffles of depressed at the same time.
+
+    Like the statsmodels fits it replaces, rows with a missing value or label are left out of each fit;
+    subjects are the distinct (person_id, depressed) pairs of df, so a subject without a label still takes part
+    in the shuffle (and leaves out the rows of whoever receives its missing label)
+    """
+
+    def __init__(self, df: pd.DataFrame, value="value", label="depressed", group="segment_type", subject="person_id"):
+        subjects = df[[subject, label]].drop_duplicates()
+        self.labels = pd.to_numeric(subjects[label], errors="coerce").to_numpy(dtype=np.float64)
+        self.n_subjects = len(subjects)
+
+        levels = sorted(df[group].dropna().unique())
+        if len(levels) != 2:
+            raise ValueError(f"The interaction needs exactly two {group} levels, found {levels}")
+        self.levels = levels
+
+        rows = df[pd.to_numeric(df[value], errors="coerce").notna() & df[group].notna()]
+        self.y = pd.to_numeric(rows[value]).to_numpy(dtype=np.float64)
+        self.s = (rows[group] == levels[1]).to_numpy(dtype=np.float64)
+        # Subject of every row, as a position in self.labels
+        self.subject_index = pd.Index(subjects[subject]).get_indexer(rows[subject])
+        self.formula = f"{value} ~ {label} * {group}"
+
+    def t_values(self, perms: np.ndarray) -> np.ndarray:
+        """
+        Interaction t statistic for every permutation in perms, a (permutations x subjects) array in which
+        row p gives subject i the label of subject perms[p, i]. Solves the 4 x 4 normal equations of every
+        permutation in one batched call
+        """
+        perms = np.atleast_2d(perms)
+        d = self.labels[perms][:, self.subject_index]          # (P x N) depressed per row
+        w = ~np.isnan(d)                                        # rows kept in each fit
+        d = np.where(w, d, 0.0)
+        w = w.astype(np.float64)
+        y, s = self.y, self.s
+
+        # X = [1, s, d, d*s] per row, with the left out rows zeroed; X'X and X'y of every permutation at once
+        ds = d * s
+        X = np.stack([w, w * s, d, ds], axis=1)                 # (P x 4 x N)
+        xtx = np.einsum("pin,pjn->pij", X, X)
+        xty = X @ y
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            inv = np.linalg.pinv(xtx)
+            beta = np.einsum("pij,pj->pi", inv, xty)
+            fitted = beta[:, [0]] + beta[:, [1]] * s + beta[:, [2]] * d + beta[:, [3]] * ds
+            rss = (w * (y - fitted) ** 2).sum(axis=1)
+            dof = w.sum(axis=1) - 4
+            se = np.sqrt(rss / dof * inv[:, 3, 3])
+            return beta[:, 3] / se
+
+    def observed(self) -> float:
+        """Interaction t statistic with the real labels"""
+        return float(self.t_values(np.arange(self.n_subjects))[0])
+
+    def fingerprint(self) -> str:
+        """Hash of everything the t statistics depend on: the formula, labels, outcome, segment types and row subjects"""
+        h = hashlib.sha256(self.formula.encode())
+        for part in (self.labels, self.y, self.s, self.subject_index):
+            h.update(np.ascontiguousarray(part).tobytes())
+        h.update(json.dumps([str(level) for level in self.levels]).encode())
+        return h.hexdigest()
+
+    def permutations(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        """n random subject permutations, as a (n x subjects) array"""
+        return rng.permuted(np.tile(np.arange(self.n_subjects), (n, 1)), axis=1)
+
+    def null_distribution(self, n_perm: int, seed: int, name: str = "") -> np.ndarray:
+        """
+        Interaction t statistics of n_perm random subject level shuffles, computed block by block in this
+        process. Gives the same values as run_permutations for the same seed and test name
+        """
+        return np.concatenate([null_block(self, seed, name, b, n) for b, n in blocks(n_perm)] or [np.empty(0)])
+
+
+def resolve_seed(seed=None) -> int:
+    """The seed of a run: seed itself, or fresh entropy (to be reported, so the run can be repeated) if it is None"""
+    return int(np.random.SeedSequence().entropy) if seed is None else int(seed)
+
+
+def block_seed(seed: int, name: str, block: int) -> np.random.SeedSequence:
+    """
+    Seed of one block of permutations of one test. It only depends on the run seed, the test name
+    (e.g. "mean/AU01_r") and the block number, not on which worker runs the block or in which order
+    """
+    return np.random.SeedSequence(seed, spawn_key=(zlib.crc32(name.encode()), block))
+
+
+def blocks(n_perm: int, block_size=BLOCK_SIZE) -> list:
+    """(block number, number of permutations) of every block of a run of n_perm permutations"""
+    return [(b, min(block_size, n_perm - start)) for b, start in enumerate(range(0, n_perm, block_size))]
+
+
+def null_block(design: InteractionDesign, seed: int, name: str, block: int, n: int) -> np.ndarray:
+    """Interaction t statistics of one block of n permutations"""
+    rng = np.random.default_rng(block_seed(seed, name, block))
+    return design.t_values(design.permutations(rng, n))
+
+
+def settled(t_obs: float, t_perm: np.ndarray, alpha: float, z=SETTLED_Z) -> bool:
+    """
+    Whether the permutations drawn so far settle the decision p < alpha: the p-value is more than z Monte Carlo
+    standard errors (of a p-value equal to alpha, with this many permutations) away from alpha
+    """
+    n = len(t_perm)
+    return n > 0 and abs(p_value(t_obs, t_perm) - alpha) > z * np.sqrt(alpha * (1 - alpha) / n)
+
+
+def _read_blocks(path, seed: int, design: InteractionDesign, plan: list) -> list:
+    """Blocks saved in path that fit plan (the blocks of this run) and were drawn for the same seed and design"""
+    if not os.path.exists(path):
+        return []
+    with np.load(path) as saved:
+        if str(saved["seed"]) != str(seed) or str(saved["design"]) != design.fingerprint():
+            return []
+        parts = np.split(saved["t_perm"], np.cumsum(saved["sizes"])[:-1])
+    out = []
+    for t_perm, (_, n) in zip(parts, plan):
+        if len(t_perm) != n:
+            break
+        out.append(t_perm)
+    return out
+
+
+def _write_blocks(path, seed: int, design: InteractionDesign, parts: list):
+    """Save the blocks of a test as a .npz with the t statistics, block sizes, seed and design fingerprint"""
+    # Write to a temporary file first so an interrupted run never leaves a half written file
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, t_perm=np.concatenate(parts), sizes=[len(part) for part in parts],
+             seed=str(seed), design=design.fingerprint())
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    """
+    Null distributions of a run in progress, saved in folder after every completed block: per test a .npz with
+    the t statistics of its completed blocks, the block sizes, the seed and the design fingerprint, next to a
+    checkpoint.json with the seed of the run. Blocks are seeded from (seed, test, block number), so the number
+    of completed blocks is all the generator state a resumed run needs to continue with identical draws.
+
+    With resume the saved blocks are picked up (and the saved seed, unless another seed is given);
+    otherwise the folder is cleared and the run starts over. Without a seed (given or saved) the run uses
+    default_seed, or fresh entropy if that is None as well
+    """
+
+    def __init__(self, folder, seed=None, resume=False, default_seed=None):
+        self.folder = str(folder)
+        self.info_path = os.path.join(self.folder, "checkpoint.json")
+        saved = None
+        if resume and os.path.exists(self.info_path):
+            with open(self.info_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        elif resume:
+            print("No checkpoint to resume in", self.folder, "- starting over")
+        if saved is None:
+            self.clear()
+        if seed is None:
+            seed = saved["seed"] if saved is not None else default_seed
+        self.seed = resolve_seed(seed)
+
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.info_path, "w", encoding="utf-8") as f:
+            json.dump({"seed": self.seed}, f, indent=2)
+
+    def _path(self, name) -> str:
+        return os.path.join(self.folder, name.replace("/", "__") + ".npz")
+
+    def load(self, name, design: InteractionDesign, plan: list) -> list:
+        return _read_blocks(self._path(name), self.seed, design, plan)
+
+    def save(self, name, design: InteractionDesign, parts: list):
+        _write_blocks(self._path(name), self.seed, design, parts)
+
+    def clear(self):
+        """Remove the saved blocks, e.g. once the run they belong to is finished"""
+        if os.path.isdir(self.folder):
+            for file in os.listdir(self.folder):
+                if file.endswith(".npz") or file == "checkpoint.json":
+                    os.remove(os.path.join(self.folder, file))
+
+
+class NullCache:
+    """
+    Finished null distributions kept in folder across runs, one .npz per test keyed by a hash of the design
+    (the input slice and the formula), the test name and the seed. The key leaves out n_perm: blocks do not
+    depend on how many follow them, so a run with fewer permutations reuses the first blocks of an entry and
+    a run with more (e.g. 10000 after 5000) only draws the missing ones. Above max_mb, the least recently
+    used entries are evicted
+    """
+
+    def __init__(self, folder, max_mb=CACHE_MAX_MB):
+        self.folder = str(folder)
+        self.max_bytes = max_mb * 1024 * 1024
+
+    def _path(self, name, design: InteractionDesign, seed: int) -> str:
+        key = hashlib.sha256(f"{design.fingerprint()}|{name}|{seed}".encode()).hexdigest()[:32]
+        return os.path.join(self.folder, key + ".npz")
+
+    def load(self, name, design: InteractionDesign, seed: int, plan: list) -> list:
+        path = self._path(name, design, seed)
+        out = _read_blocks(path, seed, design, plan)
+        if out:
+            # Mark the entry as recently used
+            os.utime(path)
+        return out
+
+    def store(self, name, design: InteractionDesign, seed: int, parts: list):
+        """Keep the blocks of a test, unless the entry already holds at least as many permutations"""
+        path = self._path(name, design, seed)
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                if saved["sizes"].sum() >= sum(map(len, parts)):
+                    return
+        os.makedirs(self.folder, exist_ok=True)
+        _write_blocks(path, seed, design, parts)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_mb"""
+        entries = [os.path.join(self.folder, f) for f in os.listdir(self.folder) if f.endswith(".npz")]
+        entries.sort(key=os.path.getmtime)
+        total = sum(map(os.path.getsize, entries))
+        while entries and total > self.max_bytes:
+            total -= os.path.getsize(entries[0])
+            os.remove(entries.pop(0))
+
+
+def run_permutations(designs: dict, n_perm: int, seed: int, workers=None, alpha=None, checkpoint=None,
+                     cache=None) -> dict:
+    """
+    Null distributions of several tests ({name: InteractionDesign}), with the (test, block) tasks spread over a
+    process pool (workers: number of processes, None = one per CPU core). Every block draws from its own
+    generator (see block_seed), so a seed gives bit-identical null distributions for any number of workers.
+
+    With alpha the run is adaptive: the blocks of a test are checked in order and the test stops drawing after
+    the first block that settles p < alpha (see settled), so only borderline tests use all n_perm permutations.
+    Blocks are drawn a few at a time per test to keep the workers busy; blocks drawn past the stopping point
+    are dropped, so the stopping point does not depend on the number of workers either.
+
+    With a Checkpoint (whose seed must be seed) every test's blocks are saved as they complete, and the blocks
+    saved by an interrupted run are used instead of drawn again, giving the same null distributions.
+    With a NullCache, blocks drawn by earlier runs are reused the same way and the finished null
+    distributions are stored in it.
+    Returns {name: array of t statistics}, n_perm long unless the test stopped early
+    """
+    workers = workers or os.cpu_count() or 1
+    pending = {name: blocks(n_perm) for name in designs}
+    t_obs = {name: design.observed() for name, design in designs.items()} if alpha is not None else {}
+    out = {name: [] for name in designs}
+
+    def add(name, t_perm):
+        """Append the next block of a test and drop the test from pending once it is complete or settled"""
+        out[name].append(t_perm)
+        pending[name] = pending[name][1:]
+        if not pending[name] or (alpha is not None and settled(t_obs[name], np.concatenate(out[name]), alpha)):
+            del pending[name]
+
+    reused = 0
+    for name, design in designs.items():
+        # The longest run of saved blocks, from the checkpoint of an interrupted run or from the cache
+        saved = []
+        if checkpoint is not None:
+            saved.append(checkpoint.load(name, design, pending[name]))
+        if cache is not None:
+            saved.append(cache.load(name, design, seed, pending[name]))
+        for t_perm in max(saved, key=len, default=[]):
+            add(name, t_perm)
+            reused += 1
+            if name not in pending:
+                break
+    if cache is not None:
+        print(f"Permutation cache: {reused} of {sum(len(blocks(n_perm)) for _ in designs)} blocks reused")
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and sum(map(len, pending.values())) > 1 else None
+    with pool or nullcontext():
+        while pending:
+            # Everything at once, or in adaptive runs the next few blocks of every test still drawing
+            ahead = n_perm if alpha is None else -(-workers // len(pending))
+            tasks = [(name, b, n) for name, todo in pending.items() for b, n in todo[:ahead]]
+            args = ([designs[name] for name, _, _ in tasks], [seed] * len(tasks), *zip(*tasks))
+            if pool is None:
+                results = map(null_block, *args)
+            else:
+                results = pool.map(null_block, *args, chunksize=max(1, len(tasks) // (4 * workers)))
+
+            # Blocks come back in task order, so each test's blocks are added (and saved) in order
+            for (name, _, _), t_perm in zip(tasks, results):
+                if name not in pending:
+                    continue
+                add(name, t_perm)
+                if checkpoint is not None:
+                    checkpoint.save(name, designs[name], out[name])
+
+    if cache is not None:
+        for name, parts in out.items():
+            if parts:
+                cache.store(name, designs[name], seed, parts)
+
+    return {name: np.concatenate(parts) if parts else np.empty(0) for name, parts in out.items()}
+
+
+def p_value(t_obs: float, t_perm: np.ndarray) -> float:
+    """Two-sided permutation p-value: the share of permuted |t| at least as large as the observed |t|"""
+    return float(np.mean(np.abs(t_perm) >= np.abs(t_obs)))
@@ -0,0 +1,337 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from common import clnf_io
+from common.clnf_io import read_clnf, read_clnf_chunks
+from common.frame_store import FRAME_FORMAT, FrameWriter, participant_path, write_frames
+from common.manifest import code_version
+
+# Version of the labeling code; every labeled output records it in its participant manifest
+LABELER_VERSION = code_version(__file__, clnf_io.__file__)
+
+# DAIC-WOZ speaker names and the interaction type they stand for
+SPEAKER_LABELS = {
+    "Ellie": "Listening",
+    "Participant": "Speaking",
+}
+
+# Numeric speaker codes some labeled files use instead of the labels
+SPEAKING_CODE = 1
+LISTENING_CODE = 0
+
+# How frames covered by more than one segment are labeled:
+#   "last"    - the segment with the latest start_time (the original behaviour; frames that only fall inside
+#               an earlier, overlapping segment are dropped)
+#   "first"   - the covering segment with the earliest start_time, so no covered frame is lost
+#   "both"    - one row per distinct covering label, so a frame in an Ellie/Participant overlap appears twice
+#   "overlap" - frames covered by both speakers get OVERLAP_LABEL, all others their single label
+OVERLAP_POLICIES = ("last", "first", "both", "overlap")
+OVERLAP_LABEL = "Overlap"
+# Frames outside every segment are dropped, or kept with GAP_LABEL when gaps are labeled
+GAP_LABEL = "Gap"
+# Turn of labeled rows that do not come from a single segment (gaps and overlaps)
+NO_TURN = -1
+
+# Streams whose labeled output keeps the turn of every row in a turn column next to the speaker label.
+# Gaze deltas are computed after the frames are cleaned, so their per turn sums need the turn there
+TURN_COLUMN_STREAMS = {"gaze"}
+
+# CLNF streams that can be labeled in one pass: input file ending, read_clnf column projection
+# and name of the labeled output (XXX_<name>.csv, or the frame store dataset <name>)
+STREAMS = {
+    "aus": ("_CLNF_AUs.txt", "aus", "CLNF_AUs_labeled"),
+    "gaze": ("_CLNF_gaze.txt", "gaze", "CLNF_gaze_labeled"),
+    "pose": ("_CLNF_pose.txt", "all", "CLNF_pose_labeled"),
+}
+
+
+def labeler_version(policy: str = "last", label_gaps: bool = False) -> str:
+    """Labeling code version plus the non-default labeling options, as recorded in the participant manifest"""
+    if policy == "last" and not label_gaps:
+        return LABELER_VERSION
+    return f"{LABELER_VERSION}:{policy}" + (":gaps" if label_gaps else "")
+
+
+def infer_masks(df: pd.DataFrame):
+    """
+    Create boolean masks for:
+    - all frames;
+    - speaking frames;
+    - listening frames.
+
+    Returns a dictionary of masks
+    """
+    if "speaker" not in df.columns:
+        raise KeyError("Your AU file has no 'speaker' column.")
+
+    sp = df["speaker"]
+
+    sp_num = pd.to_numeric(sp, errors="coerce")
+    numeric_fraction = sp_num.notna().mean()
+
+    # If almost all values are numeric, use numeric speaker codes
+    if numeric_fraction > 0.95:
+        speaking = sp_num == SPEAKING_CODE
+        listening = sp_num == LISTENING_CODE
+    else:
+        # Otherwise treat speaker labels as strings
+        s = sp.astype(str).str.strip().str.lower()
+        listening = s.eq("listening") | s.str.contains("listen")
+        speaking  = s.eq("speaking") | s.str.contains("speak")
+
+        if listening.sum() > 0 and speaking.sum() == 0:
+            speaking = ~listening
+        elif speaking.sum() > 0 and listening.sum() == 0:
+            listening = ~speaking
+
+    if listening.sum() == 0 and speaking.sum() == 0:
+        uniques = pd.Series(sp.dropna().unique()).astype(str).tolist()
+        raise RuntimeError(
+            "Could not create ANY masks.\n"
+            f"speaker dtype: {sp.dtype}\n"
+            f"unique speaker values: {uniques}\n"
+        )
+
+    allmask = pd.Series(True, index=df.index)
+    masks = {"all": allmask}
+    if speaking.sum() > 0:
+        masks["speaking"] = speaking
+    if listening.sum() > 0:
+        masks["listening"] = listening
+    return masks
+
+
+def frame_timestamps(frames: pd.DataFrame) -> np.ndarray:
+    """Timestamps of a frame table as floats; values that are not numbers become NaN"""
+    # Typed CLNF frames already have numeric timestamps, raw string frames still need converting
+    if pd.api.types.is_numeric_dtype(frames["timestamp"]):
+        return frames["timestamp"].to_numpy(dtype=float)
+    return pd.to_numeric(frames["timestamp"].astype(str).str.strip(), errors="coerce").to_numpy(dtype=float)
+
+
+class SegmentIndex:
+    """
+    Sorted start/stop/speaker arrays of one participant's speaker segments, plus an interval tree over them.
+    Built once per participant and reused to label every CLNF stream of that participant.
+    policy (see OVERLAP_POLICIES) and label_gaps decide how overlapping and uncovered frames are labeled
+    """
+
+    def __init__(self, segments_df: pd.DataFrame, policy: str = "last", label_gaps: bool = False):
+        if policy not in OVERLAP_POLICIES:
+            raise ValueError(f"Unknown overlap policy {policy!r}, expected one of {OVERLAP_POLICIES}")
+        self.policy = policy
+        self.label_gaps = label_gaps
+
+        # Remove spaces in columns names
+        segments_df = segments_df.rename(columns=lambda c: str(c).strip())
+
+        # Check if all required columns are present; otherwise, give an error
+        needed_columns_segments_df = {"speaker", "start_time", "stop_time"}
+        if not needed_columns_segments_df.issubset(segments_df.columns):
+            raise ValueError(
+                f"Segments file must contain columns: {needed_columns_segments_df}. "
+                f"Found: {list(segments_df.columns)}"
+            )
+
+        # Convert segment boundaries to numeric and drop segments that cannot be used.
+        # turn is the row of the segment in the segments file, which identifies it in per turn statistics
+        segments_df = segments_df.assign(
+            start_time=pd.to_numeric(segments_df["start_time"], errors="coerce"),
+            stop_time=pd.to_numeric(segments_df["stop_time"], errors="coerce"),
+            turn=np.arange(len(segments_df)),
+        )
+        segments_df = segments_df.dropna(subset=["speaker", "start_time", "stop_time"])
+        segments_df = segments_df.sort_values("start_time", kind="stable").reset_index(drop=True)
+
+        self.starts = segments_df["start_time"].to_numpy() # Start time of each segment
+        self.stops = segments_df["stop_time"].to_numpy() # Stop time of each segment
+        self.speakers = segments_df["speaker"].astype(str).to_numpy() # Speaker label for each segment
+        self.turns = segments_df["turn"].to_numpy() # Row of each segment in the segments file
+        # Listening (Ellie) / Speaking (Participant) label of each segment
+        self.labels = pd.Series(self.speakers).replace(SPEAKER_LABELS).to_numpy()
+
+        # Interval index over the segments: start-sorted starts/stops plus the running maximum of the stops.
+        # Every segment containing t lies between the first position whose running max stop reaches t and
+        # the last start <= t, so both ends are found with a binary search.
+        # Segments with stop < start can never contain a frame and are left out
+        proper = self.starts <= self.stops
+        self._interval_segments = np.flatnonzero(proper)
+        self._interval_starts = self.starts[proper]
+        self._interval_stops = self.stops[proper]
+        self._max_stops = np.maximum.accumulate(self._interval_stops) if proper.any() else self._interval_stops
+
+    @classmethod
+    def from_csv(cls, path, **kwargs):
+        """Build the index from an XXX_speaker_segments.csv file"""
+        return cls(pd.read_csv(path, sep=";"), **kwargs)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def version(self) -> str:
+        return labeler_version(self.policy, self.label_gaps)
+
+    def lookup(self, timestamp: np.ndarray):
+        """
+        For each timestamp t, find the last segment whose start_time <= t.
+        Returns the segment positions and a mask of the timestamps that fall inside that segment
+        """
+        if len(self) == 0:
+            return np.full(len(timestamp), -1), np.zeros(len(timestamp), dtype=bool)
+
+        idx = np.searchsorted(self.starts, timestamp, side="right") - 1
+
+        # idx may be -1 for timestamps that come before the first segment, clip to avoid indexing errors when checking stops
+        idx_clip = np.clip(idx, 0, len(self.stops) - 1)
+
+        # NaN timestamps never satisfy the comparison, so frames without a valid timestamp are dropped here
+        valid = (idx >= 0) & (timestamp <= self.stops[idx_clip])
+        return idx, valid
+
+    def matches(self, timestamp: np.ndarray):
+        """
+        Every (frame, segment) pair where the frame's timestamp lies inside the segment (both ends included).
+        Two binary searches per frame give the candidate window, so the cost is O((n + m) log m) plus the
+        window sizes, which only exceed the number of matches when one turn spans several later ones.
+        Pairs are ordered by frame, then by segment start_time. Returns frame positions and segment positions
+        """
+        if len(self._interval_starts) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        # NaN timestamps sort after everything, which gives them an empty window
+        hi = np.searchsorted(self._interval_starts, timestamp, side="right")
+        lo = np.searchsorted(self._max_stops, timestamp, side="left")
+        count = np.maximum(hi - lo, 0)
+
+        # Expand every window into (frame, candidate) pairs without a Python loop
+        frame_pos = np.repeat(np.arange(len(timestamp)), count)
+        first = np.cumsum(count) - count
+        candidate = np.repeat(lo, count) + (np.arange(len(frame_pos)) - np.repeat(first, count))
+
+        inside = self._interval_stops[candidate] >= timestamp[frame_pos]
+        return frame_pos[inside], self._interval_segments[candidate[inside]]
+
+    def label(self, frames: pd.DataFrame, return_turns: bool = False):
+        """
+        Keep the frames that fall inside a segment and add its Listening/Speaking label as first column,
+        resolving overlapping segments with the index's policy and keeping uncovered frames with a valid timestamp
+        if label_gaps is set.
+        With return_turns, also returns the turn (segments file row) each labeled row was taken from:
+        NO_TURN for gap rows and for "Overlap" rows, which belong to more than one turn
+        """
+        # Typed CLNF frames already have clean column names; only raw tables need a renamed copy
+        if any(str(c) != str(c).strip() for c in frames.columns):
+            frames = frames.rename(columns=lambda c: str(c).strip())
+
+        timestamp = frame_timestamps(frames)
+        n = len(frames)
+
+        if self.policy == "last":
+            idx, valid = self.lookup(timestamp)
+            rows = np.flatnonzero(valid)
+            segments = idx[valid]
+            labels = self.labels[segments]
+        else:
+            frame_pos, seg_pos = self.matches(timestamp)
+            pair_labels = self.labels[seg_pos]
+
+            if self.policy == "first":
+                # Pairs are sorted by segment start_time within a frame, so the first pair wins
+                rows, first = np.unique(frame_pos, return_index=True)
+                labels = pair_labels[first]
+                segments = seg_pos[first]
+            else:
+                # One row per distinct (frame, label) pair, taken from the earliest segment with that label
+                codes, uniques = pd.factorize(pair_labels)
+                n_codes = max(len(uniques), 1)
+                pairs, first_pair = np.unique(frame_pos * n_codes + codes, return_index=True)
+                rows, labels = pairs // n_codes, np.asarray(uniques, dtype=object)[pairs % n_codes]
+                segments = seg_pos[first_pair]
+
+                if self.policy == "overlap":
+                    frame_ids, first, n_labels = np.unique(rows, return_index=True, return_counts=True)
+                    labels = np.where(n_labels > 1, OVERLAP_LABEL, labels[first]).astype(object)
+                    segments = np.where(n_labels > 1, NO_TURN, segments[first])
+                    rows = frame_ids
+
+        if self.label_gaps:
+            covered = np.zeros(n, dtype=bool)
+            covered[rows] = True
+            # Frames without a valid timestamp are dropped under every policy; only real gaps are kept
+            gaps = np.flatnonzero(~covered & np.isfinite(timestamp))
+            rows = np.concatenate([rows, gaps])
+            labels = np.concatenate([np.asarray(labels, dtype=object), np.full(len(gaps), GAP_LABEL, dtype=object)])
+            segments = np.concatenate([segments, np.full(len(gaps), NO_TURN)])
+            order = np.argsort(rows, kind="stable")
+            rows, labels, segments = rows[order], labels[order], segments[order]
+
+        out = frames.iloc[rows]
+        out.insert(0, "speaker", labels)
+        if not return_turns:
+            return out
+        turns = self.turns[np.maximum(segments, 0)] if len(self.turns) else np.full(len(segments), NO_TURN)
+        return out, np.where(segments >= 0, turns, NO_TURN)
+
+
+def label_timestamps_with_segments(au_df: pd.DataFrame, segments_df: pd.DataFrame, policy: str = "last",
+                                   label_gaps: bool = False) -> pd.DataFrame:
+    """Label one frame table with the speaker segments in segments_df"""
+    return SegmentIndex(segments_df, policy, label_gaps).label(au_df)
+
+
+def labeled_path(stream, folder, prefix) -> Path:
+    """Labeled output of a stream: XXX_CLNF_*_labeled.csv in the participant folder, or its frame store partition"""
+    name = STREAMS[stream][2]
+    if FRAME_FORMAT == "parquet":
+        return participant_path(name, prefix)
+    return Path(folder) / f"{prefix}_{name}.csv"
+
+
+def label_streams(index: SegmentIndex, sources: dict, outputs: dict, chunksize=None, stats=None) -> dict:
+    """
+    Label several CLNF streams of one participant against the same segment index.
+    sources maps a stream name from STREAMS to a path, an open file or a (zip_path, member) tuple;
+    every labeled stream is written to outputs[name]. With chunksize, each stream is read, labeled and
+    appended to its output chunksize frames at a time, so memory does not grow with the session length.
+    stats optionally maps a stream name to a list of accumulators (common.online_stats.SegmentStats,
+    common.turn_stats.TurnStats) whose update(labeled, turns) gets every labeled chunk of that stream
+    together with the turn of each labeled row. Streams in TURN_COLUMN_STREAMS are written with a turn column.
+    Returns name -> (kept rows, total rows)
+    """
+    stats = stats or {}
+    counts = {}
+
+    def label(name, frames):
+        labeled, turns = index.label(frames, return_turns=True)
+        if name in TURN_COLUMN_STREAMS:
+            labeled.insert(1, "turn", turns)
+        return labeled, turns
+
+    for name, source in sources.items():
+        projection = STREAMS[name][1]
+        if chunksize is None:
+            frames = read_clnf(source, projection=projection)
+            labeled, turns = label(name, frames)
+            write_frames(labeled, outputs[name], index=False)
+            for accumulator in stats.get(name, []):
+                accumulator.update(labeled, turns)
+            counts[name] = (len(labeled), len(frames))
+            continue
+
+        kept = total = 0
+        with FrameWriter(outputs[name]) as writer:
+            for chunk in read_clnf_chunks(source, projection=projection, chunksize=chunksize):
+                labeled, turns = label(name, chunk)
+                writer.write(labeled)
+                for accumulator in stats.get(name, []):
+                    accumulator.update(labeled, turns)
+                kept += len(labeled)
+                total += len(chunk)
+        if total == 0:
+            # A file with a header but no frames gives no chunks; still write its (empty) labeled table
+            write_frames(label(name, read_clnf(source, projection=projection))[0], outputs[name], index=False)
+        counts[name] = (kept, total)
+    return counts
@@ -0,0 +1,218 @@
+import re
+from functools import cached_property
+
+import numpy as np
+
+from common.manifest import code_version
+
+# Version of the kernel code; part of the manifest version of the aggregation files
+KERNELS_VERSION = code_version(__file__)
+
+# Registry of vectorized statistic kernels. A kernel takes a GroupedValues and returns a (groups x columns)
+# array; the name is the stat written to the long-format aggregation files
+KERNELS = {}
+
+
+def register(name):
+    """Add a kernel to KERNELS under name"""
+    def wrap(kernel):
+        KERNELS[name] = kernel
+        return kernel
+    return wrap
+
+
+class GroupedValues:
+    """
+    Several value columns split into groups (e.g. participant x segment). Everything the kernels share -
+    counts, sums, central moments and the values sorted within each group - is computed once, on first use,
+    so asking for more statistics does not mean more passes over the frames. Missing values are skipped
+    """
+
+    def __init__(self, values, group_ids, n_groups):
+        self.values = np.asarray(values, dtype=np.float64)
+        if self.values.ndim == 1:
+            self.values = self.values[:, None]
+        self.group_ids = np.asarray(group_ids, dtype=np.int64)
+        self.n_groups = int(n_groups)
+        self._missing = np.isnan(self.values)
+        self._central_sums = {}
+
+    def _group_sum(self, values) -> np.ndarray:
+        """Sum of every column per group, as a (groups x columns) array"""
+        return np.column_stack([
+            np.bincount(self.group_ids, weights=values[:, j], minlength=self.n_groups)
+            for j in range(values.shape[1])
+        ]) if values.shape[1] else np.empty((self.n_groups, 0))
+
+    @cached_property
+    def count(self) -> np.ndarray:
+        return self._group_sum((~self._missing).astype(np.float64))
+
+    @cached_property
+    def _filled(self) -> np.ndarray:
+        return np.where(self._missing, 0.0, self.values)
+
+    @cached_property
+    def mean(self) -> np.ndarray:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self._group_sum(self._filled) / self.count
+
+    def central_sum(self, k) -> np.ndarray:
+        """Sum of (x - group mean) ** k per group (two-pass, so the variance stays accurate)"""
+        if k not in self._central_sums:
+            self._central_sums[k] = self._group_sum(self._deviation ** k)
+        return self._central_sums[k]
+
+    @cached_property
+    def _deviation(self) -> np.ndarray:
+        return np.where(self._missing, 0.0, self.values - self.mean[self.group_ids])
+
+    @cached_property
+    def _sorted(self):
+        """Values sorted by (group, value) per column, NaN last in each group, plus every group's first position"""
+        sorted_values = np.empty_like(self.values)
+        for j in range(self.values.shape[1]):
+            # lexsort puts NaN after every number, so each group's values come first and its NaN last
+            order = np.lexsort((self.values[:, j], self.group_ids))
+            sorted_values[:, j] = self.values[order, j]
+        sizes = np.bincount(self.group_ids, minlength=self.n_groups)
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        return sorted_values, starts
+
+    def quantile(self, q) -> np.ndarray:
+        """q-th quantile per group and column, with linear interpolation (numpy's default method)"""
+        sorted_values, starts = self._sorted
+        n = self.count
+        pos = (n - 1) * q
+        lo = np.floor(pos)
+        hi = np.ceil(pos)
+        valid = n > 0
+        col = np.arange(self.values.shape[1])[None, :]
+        lo_idx = np.where(valid, starts[:, None] + lo, 0).astype(np.int64)
+        hi_idx = np.where(valid, starts[:, None] + hi, 0).astype(np.int64)
+        if len(sorted_values) == 0:
+            return np.full(n.shape, np.nan)
+        a = sorted_values[lo_idx, col]
+        b = sorted_values[hi_idx, col]
+        return np.where(valid, a + (b - a) * (pos - lo), np.nan)
+
+    def fraction(self, mask) -> np.ndarray:
+        """Share of the (non missing) values per group for which mask is True"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self._group_sum((mask & ~self._missing).astype(np.float64)) / self.count
+
+
+def grouped_stats(values, group_ids, n_groups, stats: dict) -> np.ndarray:
+    """
+    Compute every statistic in stats (name -> kernel) for every group and column in one grouped pass.
+    Returns a (groups x columns x statistics) array
+    """
+    grouped = GroupedValues(values, group_ids, n_groups)
+    if not stats:
+        return np.empty((grouped.n_groups, grouped.values.shape[1], 0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.stack([kernel(grouped) for kernel in stats.values()], axis=-1)
+
+
+def std_kernel(ddof=0):
+    """Standard deviation with ddof delta degrees of freedom (0 like np.std, 1 like pandas)"""
+    def kernel(g):
+        return np.where(g.count > ddof, np.sqrt(g.central_sum(2) / (g.count - ddof)), np.nan)
+    return kernel
+
+
+def quantile_kernel(q):
+    def kernel(g):
+        return g.quantile(q)
+    return kernel
+
+
+def frac_above_kernel(threshold):
+    """Share of the values strictly above threshold"""
+    def kernel(g):
+        with np.errstate(invalid="ignore"):
+            return g.fraction(g.values > threshold)
+    return kernel
+
+
+@register("count")
+def _count(g):
+    return g.count
+
+
+@register("mean")
+def _mean(g):
+    return np.where(g.count > 0, g.mean, np.nan)
+
+
+register("std")(std_kernel(ddof=0))
+register("sample_std")(std_kernel(ddof=1))
+
+
+@register("var")
+def _var(g):
+    return np.where(g.count > 0, g.central_sum(2) / g.count, np.nan)
+
+
+@register("min")
+def _min(g):
+    return g.quantile(0.0)
+
+
+@register("max")
+def _max(g):
+    return g.quantile(1.0)
+
+
+register("median")(quantile_kernel(0.5))
+register("q25")(quantile_kernel(0.25))
+register("q75")(quantile_kernel(0.75))
+
+
+@register("iqr")
+def _iqr(g):
+    return g.quantile(0.75) - g.quantile(0.25)
+
+
+@register("skew")
+def _skew(g):
+    """Adjusted Fisher-Pearson skewness, as pandas' skew()"""
+    n, m2, m3 = g.count, g.central_sum(2), g.central_sum(3)
+    value = np.sqrt(n * (n - 1)) / (n - 2) * (m3 / n) / (m2 / n) ** 1.5
+    # Constant values have no skew (pandas gives 0 as well)
+    value = np.where(m2 == 0, 0.0, value)
+    return np.where(n >= 3, value, np.nan)
+
+
+@register("kurtosis")
+def _kurtosis(g):
+    """Unbiased excess kurtosis, as pandas' kurt()"""
+    n, m2, m4 = g.count, g.central_sum(2), g.central_sum(4)
+    value = (n + 1) * n * (n - 1) * m4 / ((n - 2) * (n - 3) * m2 ** 2) - 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))
+    value = np.where(m2 == 0, 0.0, value)
+    return np.where(n >= 4, value, np.nan)
+
+
+# Share of frames in which an action unit is present; meant for the binary AU*_c columns
+register("activation_rate")(frac_above_kernel(0.5))
+
+# Share of frames with an AU intensity above 1 on the 0-5 AU*_r scale
+register("frac_above_1")(frac_above_kernel(1.0))
+
+
+def resolve_stats(names) -> dict:
+    """
+    Kernels for a list of stat names: names from KERNELS, plus "qNN" for any percentile (e.g. q10)
+    and "frac_above_X" for any threshold (e.g. frac_above_2.5)
+    """
+    out = {}
+    for name in names:
+        if name in KERNELS:
+            out[name] = KERNELS[name]
+        elif re.fullmatch(r"q\d{1,2}(\.\d+)?", name):
+            out[name] = quantile_kernel(float(name[1:]) / 100)
+        elif re.fullmatch(r"frac_above_-?\d+(\.\d+)?", name):
+            out[name] = frac_above_kernel(float(name[len("frac_above_"):]))
+        else:
+            raise ValueError(f"Unknown statistic {name!r}. Known: {sorted(KERNELS)}, qNN, frac_above_X")
+    return out
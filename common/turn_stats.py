@@ -0,0 +1,130 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from common.frame_store import filter_mask
+from common.manifest import code_version
+
+# Version of the turn statistics code; part of the manifest version of every turn statistics file
+TURN_STATS_VERSION = code_version(__file__)
+
+# Columns of a turn statistics table: per participant, speaker turn (the row of the turn in
+# XXX_speaker_segments.csv, segment_labeler.NO_TURN for frames outside every turn or in an Ellie/Participant
+# overlap), role (the speaker label of the frames) and feature column, the number of values, their sum and
+# their sum of squares
+TURN_STATS_COLUMNS = ["person_id", "turn", "role", "column", "n", "sum", "sumsq"]
+
+# Aggregation levels of rollup() and the keys (besides the participant keys) they group by
+ROLLUP_LEVELS = {
+    "turn": ["turn", "role", "column"],
+    "role": ["role", "column"],
+    "session": ["column"],
+}
+
+
+def turn_sums(values: pd.DataFrame, turn, role, person_id) -> pd.DataFrame:
+    """
+    Sufficient statistics of every column of values per (participant, turn, role), in one grouped pass.
+    turn and role hold one entry per row of values; person_id is one participant ID or one per row.
+    Missing values are not counted
+    """
+    x = values.apply(pd.to_numeric, errors="coerce").astype(np.float64).reset_index(drop=True)
+    if np.ndim(person_id) == 0:
+        person_id = np.full(len(x), person_id)
+    keys = [
+        pd.Series(np.asarray(person_id), name="person_id"),
+        pd.Series(np.asarray(turn), name="turn"),
+        pd.Series(np.asarray(role, dtype=object), name="role"),
+    ]
+    parts = pd.concat([x, x ** 2, x.notna().astype(np.float64)], axis=1, keys=["sum", "sumsq", "n"])
+    sums = parts.groupby(keys, sort=True).sum()
+
+    if sums.empty:
+        return pd.DataFrame(columns=TURN_STATS_COLUMNS)
+
+    # Wide (participant, turn, role) x (stat, column) -> long rows with one n/sum/sumsq per column
+    out = sums.stack(level=1, future_stack=True).rename_axis(["person_id", "turn", "role", "column"]).reset_index()
+    out["n"] = out["n"].astype(np.int64)
+    return out[TURN_STATS_COLUMNS]
+
+
+def combine(parts) -> pd.DataFrame:
+    """Add up turn statistics of the same (participant, turn, role, column), e.g. from several chunks"""
+    parts = [p for p in parts if not p.empty]
+    if not parts:
+        return pd.DataFrame(columns=TURN_STATS_COLUMNS)
+    df = pd.concat(parts, ignore_index=True)
+    keys = [c for c in df.columns if c not in ("n", "sum", "sumsq")]
+    return df.groupby(keys, sort=False, dropna=False)[["n", "sum", "sumsq"]].sum().reset_index()
+
+
+class TurnStats:
+    """
+    Per turn statistics of labeled frames, updated chunk by chunk while the frames are labeled.
+    columns picks the feature columns (a list or a function of the column name); filters are the
+    (column, op, value) frame filters of the aggregation and are applied before anything is counted
+    """
+
+    def __init__(self, person_id, columns, filters=None):
+        self.person_id = person_id
+        self._select = columns
+        self.filters = list(filters or [])
+        self._parts = []
+
+    def update(self, labeled: pd.DataFrame, turns=None):
+        if turns is None:
+            raise ValueError("TurnStats needs the turn of every labeled row")
+        if callable(self._select):
+            columns = [c for c in labeled.columns if self._select(c)]
+        else:
+            columns = [c for c in self._select if c in labeled.columns]
+
+        keep = filter_mask(labeled, self.filters)
+        self._parts.append(turn_sums(
+            labeled.loc[keep, columns],
+            np.asarray(turns)[keep],
+            labeled["speaker"].to_numpy()[keep],
+            self.person_id,
+        ))
+
+    def to_frame(self) -> pd.DataFrame:
+        # A turn that was split over two chunks is added back together here
+        return combine(self._parts).sort_values(["turn", "role"], kind="stable", ignore_index=True)
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.to_frame().to_csv(path, index=False)
+
+
+def load_turn_stats(paths) -> pd.DataFrame:
+    """Read and concatenate turn statistics files"""
+    parts = [pd.read_csv(p) for p in paths]
+    parts = [p for p in parts if not p.empty]
+    if not parts:
+        return pd.DataFrame(columns=TURN_STATS_COLUMNS)
+    return pd.concat(parts, ignore_index=True)
+
+
+def rollup(store: pd.DataFrame, level: str = "session", ddof: int = 0, by=("person_id",)) -> pd.DataFrame:
+    """
+    Mean and standard deviation per participant at one aggregation level (see ROLLUP_LEVELS) from a turn
+    statistics table, by adding up its sums instead of reading any frame. by are the participant keys kept
+    in the output. Returns the keys plus n, mean and std (NaN when there are not more than ddof values)
+    """
+    if level not in ROLLUP_LEVELS:
+        raise ValueError(f"Unknown level {level!r}, expected one of {list(ROLLUP_LEVELS)}")
+    keys = list(by) + ROLLUP_LEVELS[level]
+
+    sums = store.groupby(keys, sort=False, dropna=False)[["n", "sum", "sumsq"]].sum().reset_index()
+    n = sums["n"].to_numpy(dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums["sum"].to_numpy() / n
+        # Rounding can push the variance of (nearly) constant values slightly below zero
+        var = np.maximum(sums["sumsq"].to_numpy() - sums["sum"].to_numpy() * mean, 0.0) / (n - ddof)
+
+    out = sums[keys + ["n"]].copy()
+    out["mean"] = np.where(n > 0, mean, np.nan)
+    out["std"] = np.where(n > ddof, np.sqrt(var), np.nan)
+    return out
@@ -1,3 +1,7 @@
+import sys
+import argparse
+import hashlib
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
@@ -5,34 +9,75 @@ from pathlib import Path
 SCRIPT_DIR = Path(__file__).parent.resolve() # BachelorProject/gaze
 DATA_DIR = SCRIPT_DIR.parent / "data" # BachelorProject/data
 OUTPUT_PATH = DATA_DIR / "gaze_aggregation.csv" # BachelorProject/data/gaze_aggregation.csv
+TURN_STATS_PATH = DATA_DIR / "gaze_turn_stats.csv" # BachelorProject/data/gaze_turn_stats.csv
+DEPRESSION_PATH = DATA_DIR / "depression.csv" # BachelorProject/data/depression.csv
+# Which deltas each participant's rows in OUTPUT_PATH were aggregated from, for --incremental
+MANIFEST_PATH = DATA_DIR / "gaze_aggregation_manifest.json" # BachelorProject/data/gaze_aggregation_manifest.json
+
+# Make the shared helpers in BachelorProject/common importable
+sys.path.insert(0, str(SCRIPT_DIR.parent))
+from common.frame_store import FRAME_FORMAT, list_partitions, read_dataset, read_frames
+from common.incremental import merge_participants, read_existing
+from common.manifest import Manifest, code_version
+from common.stat_kernels import KERNELS, KERNELS_VERSION, grouped_stats, resolve_stats
+from common.turn_stats import rollup
+from gaze_preprocessing import COMPACT_DTYPES, compact_gaze, load_depression_labels, memory_mb, memory_report
+
+# The only columns the aggregation uses
+DELTA_COLUMNS = ["person_id", "depressed", "delta_deg"]
+# Columns of the output and the ones that identify a row
+OUTPUT_COLUMNS = ["person_id", "stat", "depressed", "segment_type", "value"]
+OUTPUT_KEYS = ["person_id", "segment_type", "stat"]
+# Statistics per participant and segment, by name from the kernel registry in common/stat_kernels.py
+GAZE_STATS = ["mean", "std"]
+# Gaze uses pandas' std (sample standard deviation), so "std" here is the registry's sample_std
+GAZE_KERNELS = {"std": KERNELS["sample_std"]}
+# Statistics --from-turns can roll up from the per turn sums
+TURN_STATS = {"mean", "std"}
+
+def gaze_kernels(stats=None) -> dict:
+    """Kernels of the requested statistics (default GAZE_STATS)"""
+    names = list(GAZE_STATS if stats is None else stats)
+    kernels = resolve_stats([k for k in names if k not in GAZE_KERNELS])
+    return {k: GAZE_KERNELS.get(k) or kernels[k] for k in names}
 
 def load_data(file: Path) -> pd.DataFrame:
     """
-    Loading gaze delta values file
+    Loading gaze delta values file (only the columns the aggregation uses)
     """
-    return pd.read_csv(file)
-
-def aggregate_file(df: pd.DataFrame, segment: str) -> pd.DataFrame:
+    if FRAME_FORMAT == "parquet":
+        df = read_dataset(file.stem, columns=DELTA_COLUMNS)
+    else:
+        df = pd.read_csv(file, usecols=DELTA_COLUMNS)
+
+    before = memory_mb(df)
+    df = compact_gaze(df)
+    if COMPACT_DTYPES:
+        memory_report(file.stem, before, memory_mb(df))
+    return df
+
+def aggregate_file(df: pd.DataFrame, segment: str, stats=None) -> pd.DataFrame:
     """
-    Aggregate values for a single file and format output
+    Aggregate values for a single file and format output. Every requested statistic
+    (default GAZE_STATS) of every participant comes from one grouped pass over the deltas
     """
+    kernels = gaze_kernels(stats)
+
     # get depression label per person
-    depression_map = df.groupby("person_id")["depressed"].first()
+    depression_map = df.groupby("person_id", observed=True)["depressed"].first()
 
-    # compute stats
-    stats = (
-        df.groupby("person_id")["delta_deg"]
-        .agg(["mean", "std"])
-        .reset_index()
-    )
+    # compute stats (rows without a person_id are left out, as groupby does)
+    codes, persons = pd.factorize(df["person_id"], sort=True)
+    keep = codes >= 0
+    values = pd.to_numeric(df["delta_deg"], errors="coerce").to_numpy(dtype=np.float64)[keep]
+    result = grouped_stats(values, codes[keep], len(persons), kernels)[:, 0, :]
 
     # convert to long format
-    stats = stats.melt(
-        id_vars="person_id",
-        value_vars=["mean", "std"],
-        var_name="stat",
-        value_name="value"
-    )
+    stats = pd.DataFrame({
+        "person_id": np.tile(np.asarray(persons), len(kernels)),
+        "stat": np.repeat(list(kernels), len(persons)),
+        "value": result.T.ravel(),
+    })
 
     # attach depression label
     stats["depressed"] = stats["person_id"].map(depression_map)
@@ -41,18 +86,15 @@ def aggregate_file(df: pd.DataFrame, segment: str) -> pd.DataFrame:
     stats["segment_type"] = segment
 
     # reorder columns
-    stats = stats[["person_id", "stat", "depressed", "segment_type", "value"]]
+    stats = stats[OUTPUT_COLUMNS]
 
     return stats
 
-def combine_files(files:list, segments:list) -> pd.DataFrame:
+def combine_tables(tables:dict, stats=None) -> pd.DataFrame:
     """
-    Combine aggregated files into a single output
+    Aggregate delta tables that are already in memory ({segment: table with DELTA_COLUMNS}) into a single output
     """
-    dfs = [
-        aggregate_file(load_data(file), segment)
-        for file, segment in zip(files, segments)
-    ]
+    dfs = [aggregate_file(df, segment, stats) for segment, df in tables.items()]
 
     combined = pd.concat(dfs, ignore_index=True)
 
@@ -61,8 +103,136 @@ def combine_files(files:list, segments:list) -> pd.DataFrame:
 
     return combined
 
+def combine_files(files:list, segments:list, stats=None) -> pd.DataFrame:
+    """
+    Combine aggregated files into a single output
+    """
+    return combine_tables({segment: load_data(file) for file, segment in zip(files, segments)}, stats)
+
+def save_untracked(combined:pd.DataFrame):
+    """
+    Write the output when it was not aggregated from the delta files, and drop its manifest record,
+    so the next --incremental run rebuilds it instead of merging into it
+    """
+    combined.to_csv(OUTPUT_PATH, index=False)
+    manifest = Manifest(MANIFEST_PATH)
+    manifest.forget(OUTPUT_PATH)
+    manifest.save()
+
+def segment_inputs(file:Path, segment:str, manifest:Manifest):
+    """
+    Fingerprint of every participant's deltas in one segment file, named "<segment>/<person_id>", and a function
+    that loads the deltas of a set of participant IDs. A parquet dataset is fingerprinted per partition and only
+    the requested partitions are read; a csv file holds every participant, so it is read once and its rows are
+    hashed per participant
+    """
+    if FRAME_FORMAT == "parquet":
+        partitions = list_partitions(file.stem)
+        inputs = manifest.fingerprints(OUTPUT_PATH, {f"{segment}/{pid}": path for pid, path in partitions.items()})
+
+        def load(ids):
+            dfs = [read_frames(partitions[pid], columns=DELTA_COLUMNS).assign(person_id=int(pid))
+                   for pid in sorted(ids) if pid in partitions]
+            return compact_gaze(pd.concat(dfs, ignore_index=True)) if dfs else pd.DataFrame(columns=DELTA_COLUMNS)
+        return inputs, load
+
+    df = load_data(file)
+    person = df["person_id"].astype(str)
+    hashes = pd.util.hash_pandas_object(df[DELTA_COLUMNS], index=False).to_numpy()
+    inputs = {
+        f"{segment}/{pid}": {"name": file.name, "size": len(rows), "sha256": hashlib.sha256(hashes[rows].tobytes()).hexdigest()}
+        for pid, rows in df.groupby(person).indices.items()
+    }
+    return inputs, lambda ids: df[person.isin(ids)]
+
+def combine_changed(files:list, segments:list, stats=None, incremental=False):
+    """
+    combine_files that records which deltas every participant was aggregated from. With incremental, only the
+    participants whose deltas are new or changed since the last run are aggregated; the rows of the others
+    are taken from the existing output. Returns the combined output and the manifest to save with it
+    """
+    manifest = Manifest(MANIFEST_PATH)
+    version = f"{code_version(__file__)}-{KERNELS_VERSION}:{','.join(gaze_kernels(stats))}"
+
+    inputs, loaders = {}, {}
+    for file, segment in zip(files, segments):
+        segment_fps, loaders[segment] = segment_inputs(file, segment, manifest)
+        inputs.update(segment_fps)
+
+    delta = manifest.changed_inputs(OUTPUT_PATH, inputs, version) if incremental else None
+    if delta is None:
+        changed = {name.split("/", 1)[1] for name in inputs}
+    else:
+        # A participant is aggregated again, in every segment, if any of its segments is new, changed or gone
+        changed = {name.split("/", 1)[1] for name in delta[0] | delta[1]}
+        print(f"Incremental: {len(changed)} new, changed or removed participants")
+
+    dfs = [aggregate_file(loaders[segment](changed), segment, stats) for segment in segments]
+    dfs = [df for df in dfs if not df.empty]
+    combined = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=OUTPUT_COLUMNS)
+
+    if delta is None:
+        combined = combined.sort_values(["person_id", "segment_type", "stat"])
+    else:
+        existing = read_existing(OUTPUT_PATH, OUTPUT_COLUMNS)
+        combined = merge_participants(existing, combined, changed,
+                                      keys=OUTPUT_KEYS, sort_by=["person_id", "segment_type", "stat"])
+        # The labels are joined again for every participant, so edits to depression.csv are picked up
+        labelmap = load_depression_labels(DEPRESSION_PATH)
+        combined["depressed"] = combined["person_id"].astype(str).map(labelmap)
+
+    manifest.record(OUTPUT_PATH, inputs, version)
+    return combined, manifest
+
+def combine_turn_stats(store:pd.DataFrame, depression_file:Path) -> pd.DataFrame:
+    """
+    Same output as combine_files, rolled up from the per turn sums written by gaze_features.py
+    instead of reading the delta files: "all" is the whole session, listening/speaking the two roles
+    """
+    # pandas' std (sample standard deviation), as in aggregate_file
+    sessions = rollup(store, "session", ddof=1).assign(segment_type="all")
+    roles = rollup(store, "role", ddof=1)
+    roles = roles[roles["role"].isin(["Listening", "Speaking"])].copy()
+    roles["segment_type"] = roles["role"].str.lower()
+
+    stats = pd.concat([sessions, roles], ignore_index=True)
+    stats = stats.melt(
+        id_vars=["person_id", "segment_type"],
+        value_vars=["mean", "std"],
+        var_name="stat",
+        value_name="value"
+    )
+
+    labelmap = load_depression_labels(depression_file)
+    stats["depressed"] = stats["person_id"].astype(str).map(labelmap)
+
+    stats = stats[["person_id", "stat", "depressed", "segment_type", "value"]]
+    return stats.sort_values(["person_id", "segment_type", "stat"])
+
 def main():
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from-turns", action="store_true",
+                        help="roll the aggregation up from gaze_turn_stats.csv instead of reading the delta files")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only aggregate participants whose deltas are new or changed since the last run "
+                             "and merge them into the existing gaze_aggregation.csv")
+    parser.add_argument("--stats", default=",".join(GAZE_STATS),
+                        help="comma separated statistics to compute (default: %(default)s), "
+                             "e.g. mean,std,median,iqr,skew,kurtosis,q90,frac_above_10")
+    args = parser.parse_args()
+    stats = [k.strip() for k in args.stats.split(",") if k.strip()]
+    # Fail on unknown names before any file is read
+    gaze_kernels(stats)
+
+    if args.from_turns:
+        if set(stats) != TURN_STATS:
+            parser.error(f"--from-turns can only compute {sorted(TURN_STATS)}")
+        if args.incremental:
+            parser.error("--incremental works on the delta files, not with --from-turns")
+        save_untracked(combine_turn_stats(pd.read_csv(TURN_STATS_PATH), DEPRESSION_PATH))
+        return
+
     files = [
         DATA_DIR / "combined_gaze_deltas.csv",
         DATA_DIR / "listening_gaze_deltas.csv",
@@ -71,9 +241,10 @@ def main():
 
     segments = ["all", "listening", "speaking"]
 
-    combined = combine_files(files, segments)
+    combined, manifest = combine_changed(files, segments, stats, args.incremental)
 
     combined.to_csv(OUTPUT_PATH, index=False)
+    manifest.save()
 
     return
 
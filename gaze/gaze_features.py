@@ -1,3 +1,4 @@
+import sys
 import pandas as pd
 import numpy as np
 from pathlib import Path
@@ -7,21 +8,63 @@ import argparse
 SCRIPT_DIR = Path(__file__).parent.resolve() # BachelorProject/gaze
 DATA_DIR = SCRIPT_DIR.parent / "data" # BachelorProject/data
 CLEANED_PATH = DATA_DIR / "gaze_cleaned_labeled_0.7.csv" # BachelorProject/data/gaze_cleaned_labeled_0.7.csv
+TURN_STATS_PATH = DATA_DIR / "gaze_turn_stats.csv" # BachelorProject/data/gaze_turn_stats.csv
+
+# Role of the delta between the last frame of one turn and the first frame of the next;
+# it is part of the "all" deltas but of neither the listening nor the speaking deltas
+TRANSITION_ROLE = "Transition"
+
+# Delta file of every segment
+DELTA_FILES = {
+    "all": DATA_DIR / "combined_gaze_deltas.csv",
+    "listening": DATA_DIR / "listening_gaze_deltas.csv",
+    "speaking": DATA_DIR / "speaking_gaze_deltas.csv",
+}
+# Speaker label of the frames of the listening/speaking segments
+SEGMENT_SPEAKERS = {"listening": "Listening", "speaking": "Speaking"}
+# Columns written with --slim
+SLIM_COLUMNS = ["person_id", "depressed", "speaker", "segment_type", "delta_rad", "delta_deg"]
+
+# Make the shared helpers in BachelorProject/common importable
+sys.path.insert(0, str(SCRIPT_DIR.parent))
+from common.frame_store import FRAME_FORMAT, read_dataset, write_partitioned
+from common.turn_stats import turn_sums
+from gaze_preprocessing import COMPACT_DTYPES, compact_gaze, memory_mb, memory_report
+from gaze_aggregation import DELTA_COLUMNS, GAZE_STATS, combine_tables, gaze_kernels, save_untracked
 
 def load_data(file:Path) -> pd.DataFrame:
     """
-    Load clean data 
+    Load clean data (the csv file, or the parquet dataset with the same name)
     """
+    if FRAME_FORMAT == "parquet":
+        df = read_dataset(file.stem)
+    else:
+        df = pd.read_csv(file)
+
+    before = memory_mb(df)
+    df = compact_gaze(df)
+    if COMPACT_DTYPES:
+        memory_report(file.stem, before, memory_mb(df))
+    return df
 
-    return pd.read_csv(file)
+def save_data(df:pd.DataFrame, file:Path):
+    """
+    Save a delta table as csv, or as a parquet dataset with the same name
+    """
+    if FRAME_FORMAT == "parquet":
+        write_partitioned(df, file.stem)
+    else:
+        df.to_csv(file, index=False)
 
 def average_eyes(df:pd.DataFrame) -> pd.DataFrame:
     """
     Take average gaze of the two eyes and renormalize vector
     """
-    df["x_avg"] = (df.x_0 + df.x_1)/2
-    df["y_avg"] = (df.y_0 + df.y_1)/2
-    df["z_avg"] = (df.z_0 + df.z_1)/2
+    # the average is computed in float64, also when the eye vectors are held as float32
+    eyes = df[["x_0","y_0","z_0","x_1","y_1","z_1"]].astype(np.float64)
+    df["x_avg"] = (eyes.x_0 + eyes.x_1)/2
+    df["y_avg"] = (eyes.y_0 + eyes.y_1)/2
+    df["z_avg"] = (eyes.z_0 + eyes.z_1)/2
 
     # renormalize the averaged gaze vector
     norm = np.sqrt(df.x_avg**2 + df.y_avg**2 + df.z_avg**2)
@@ -29,26 +72,67 @@ def average_eyes(df:pd.DataFrame) -> pd.DataFrame:
 
     return df
 
-def get_delta(df:pd.DataFrame, group_cols:list) -> pd.DataFrame:
+def get_turn_stats(df_all:pd.DataFrame) -> pd.DataFrame:
     """
-    Computes delta angle between frames and returns it in radians and degrees
+    Per turn sums of the "all" gaze deltas (see common/turn_stats.py). The turn of a frame is the row of its
+    segment in XXX_speaker_segments.csv (the turn column written while labeling), as in the AU turn files.
+    The delta into the first frame of a run of one speaker gets TRANSITION_ROLE, so rolling up a role gives
+    the listening/speaking deltas and rolling up a session gives the "all" deltas
     """
-    V = df[["x_avg","y_avg","z_avg"]].to_numpy()
+    person = df_all["person_id"]
+    speaker = df_all["speaker"]
+    boundary = (person != person.shift()) | (speaker != speaker.shift())
+    role = np.where(boundary, TRANSITION_ROLE, speaker.astype(object))
+
+    if "turn" in df_all.columns:
+        turn = df_all["turn"].to_numpy()
+    else:
+        # frames labeled before the turn column was written: the runs of one speaker, numbered from 0
+        print("No turn column in the gaze frames, numbering speaker runs instead; relabel to get the segment turns")
+        run = boundary.cumsum()
+        turn = (run - run.groupby(person, observed=True).transform("min")).to_numpy()
+
+    return turn_sums(df_all[["delta_deg"]], turn, role, person.to_numpy())
+
+def row_starts(values:pd.Series) -> np.ndarray:
+    """
+    True for every row whose value differs from the row before it, and for the first row
+    """
+    return (values != values.shift()).to_numpy()
 
-    V_prev = (
-        df.groupby(group_cols)[["x_avg","y_avg","z_avg"]]
-        .shift()
-        .to_numpy()
-    )
+def fused_deltas(df:pd.DataFrame) -> dict:
+    """
+    Delta tables for all, listening and speaking frames from one pass over the averaged gaze vectors.
+    The angle between every frame and the frame before it is computed once; a delta is only kept within a
+    participant (all) or within a run of frames of one speaker (listening/speaking), so the three tables
+    differ only in which deltas are masked out at the run starts. "all" adds its columns to df itself,
+    listening/speaking are row selections of it. Returns {"all": ..., "listening": ..., "speaking": ...}
+    """
+    V = df[["x_avg","y_avg","z_avg"]].to_numpy()
+    dot = np.einsum("ij,ij->i", V[1:], V[:-1])
+    delta_rad = np.concatenate([[np.nan], np.arccos(np.clip(dot, -1, 1))])
 
-    dot = np.einsum("ij,ij->i", V, V_prev)
+    person_start = row_starts(df["person_id"])
+    run_start = person_start | row_starts(df["speaker"])
+    run = np.cumsum(run_start)
+    run_delta = np.where(run_start, np.nan, delta_rad)
 
-    df["delta_rad"] = np.arccos(np.clip(dot, -1, 1))
+    df["segment_type"] = np.cumsum(person_start)
+    df["delta_rad"] = np.where(person_start, np.nan, delta_rad)
     df["delta_deg"] = np.rad2deg(df["delta_rad"])
+    out = {"all": df}
 
-    return df
+    for segment, label in SEGMENT_SPEAKERS.items():
+        rows = (df["speaker"] == label).to_numpy()
+        part = df[rows].copy()
+        part["segment_type"] = run[rows]
+        part["delta_rad"] = run_delta[rows]
+        part["delta_deg"] = np.rad2deg(part["delta_rad"])
+        out[segment] = part
+
+    return out
 
-def main(file:Path):
+def main(file:Path, slim:bool=False, aggregate:bool=False, write_deltas:bool=True, stats=None):
 
     print("Loading data...")
     df = load_data(file)
@@ -56,48 +140,47 @@ def main(file:Path):
     print("Averaging eyes...")
     df = average_eyes(df)
 
-    
-    # --- ALL ---
-    print("Creating file for all...")
-    df_all = df.copy()
-    df_all["segment_type"] = (df_all["person_id"] != df_all["person_id"].shift()).cumsum()
-    df_all = get_delta(df_all, ["segment_type"])
-
-    # --- LISTENING ---
-    print("Creating file for listening...")
-    df_listening = df.copy()
-    boundary = (
-        (df_listening["person_id"] != df_listening["person_id"].shift()) |
-        (df_listening["speaker"] != df_listening["speaker"].shift())
-    )
-    df_listening["segment_type"] = boundary.cumsum()
-    df_listening = df_listening[df_listening["speaker"] == "Listening"]
-    df_listening = get_delta(df_listening, ["segment_type"])
-
-    # --- SPEAKING ---
-    print("Creating file for sepaking...")
-    df_speaking = df.copy()
-    boundary = (
-        (df_speaking["person_id"] != df_speaking["person_id"].shift()) |
-        (df_speaking["speaker"] != df_speaking["speaker"].shift())
-    )
-    df_speaking["segment_type"] = boundary.cumsum()
-    df_speaking = df_speaking[df_speaking["speaker"] == "Speaking"]
-    df_speaking = get_delta(df_speaking, ["segment_type"])
+    print("Computing deltas...")
+    deltas = fused_deltas(df)
 
-    print("Saving files...")
-    combined_file = DATA_DIR / "combined_gaze_deltas.csv"
-    listening_file = DATA_DIR / "listening_gaze_deltas.csv"
-    speaking_file = DATA_DIR / "speaking_gaze_deltas.csv"
+    if write_deltas:
+        print("Saving files...")
+        for segment, delta_file in DELTA_FILES.items():
+            out = deltas[segment]
+            if slim:
+                out = out[[c for c in SLIM_COLUMNS if c in out.columns]]
+            save_data(out, delta_file)
+    get_turn_stats(deltas["all"]).to_csv(TURN_STATS_PATH, index=False)
 
-    df_all.to_csv(combined_file, index=False)
-    df_listening.to_csv(listening_file, index=False)
-    df_speaking.to_csv(speaking_file, index=False)
+    if aggregate:
+        # the delta tables go to the aggregation as they are, without being written and parsed again
+        print("Aggregating deltas...")
+        save_untracked(combine_tables({segment: deltas[segment][DELTA_COLUMNS] for segment in DELTA_FILES}, stats))
 
     return
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slim", action="store_true",
+                        help="write only the columns later steps use (see SLIM_COLUMNS) instead of every frame column")
+    parser.add_argument("--aggregate", action="store_true",
+                        help="also write gaze_aggregation.csv from the deltas in memory (replaces gaze_aggregation.py)")
+    parser.add_argument("--no-deltas", action="store_true",
+                        help="with --aggregate, do not write the three delta files at all")
+    parser.add_argument("--stats", default=",".join(GAZE_STATS),
+                        help="with --aggregate, comma separated statistics to compute (default: %(default)s)")
+    args = parser.parse_args()
+    if args.no_deltas and not args.aggregate:
+        parser.error("--no-deltas needs --aggregate, otherwise nothing uses the deltas")
+    stats = [k.strip() for k in args.stats.split(",") if k.strip()]
+    # Fail on unknown names before any file is read
+    gaze_kernels(stats)
+
     main(
-        file=CLEANED_PATH
-    )
\ No newline at end of file
+        file=CLEANED_PATH,
+        slim=args.slim,
+        aggregate=args.aggregate,
+        write_deltas=not args.no_deltas,
+        stats=stats
+    )
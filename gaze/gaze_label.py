@@ -1,7 +1,6 @@
 import argparse
 import os
-import numpy as np
-import pandas as pd
+import sys
 from pathlib import Path
 
 # -----------------------------
@@ -11,67 +10,28 @@ SCRIPT_DIR = Path(__file__).parent.resolve()
 DATA_DIR = SCRIPT_DIR.parent / "data"
 ROOT_DIR = DATA_DIR / "participant_folders"
 
-
-def label_timestamps_with_segments(au_df: pd.DataFrame, segments_df: pd.DataFrame) -> pd.DataFrame:
-    # Using copies to not modify the orginal data
-    au_df = au_df.copy()
-    segments_df = segments_df.copy()
-    # Remove spaces in columns names
-    au_df.columns = au_df.columns.str.strip()
-    segments_df.columns = segments_df.columns.str.strip()
-
-    # Check if all required columns are present; otherwise, give an error
-    needed_columns_segments_df = {"speaker", "start_time", "stop_time"}
-    if not needed_columns_segments_df.issubset(segments_df.columns):
-        raise ValueError(
-            f"Segments file must contain columns: {needed_columns_segments_df}. "
-            f"Found: {list(segments_df.columns)}"
-        )
-
-    au_df["timestamp_raw"] = au_df["timestamp"].astype(str)
-    au_df["timestamp_num"] = pd.to_numeric(au_df["timestamp_raw"].str.strip(), errors="coerce")
-
-    # Convert segment boundaries to numeric
-    segments_df["start_time"] = pd.to_numeric(segments_df["start_time"], errors="coerce")
-    segments_df["stop_time"] = pd.to_numeric(segments_df["stop_time"], errors="coerce")
-
-    # Drop all AU rows with no valid timestamp
-    au_df = au_df.dropna(subset=["timestamp_num"]).copy()
-    segments_df = segments_df.dropna(subset=["speaker", "start_time", "stop_time"]).copy()
-
-    segments_df = segments_df.sort_values("start_time").reset_index(drop=True)
-
-    starts = segments_df["start_time"].to_numpy() # Start time of each segment
-    stops = segments_df["stop_time"].to_numpy() # Stop time of each segment
-    speakers = segments_df["speaker"].astype(str).to_numpy() # Speaker label for each segment
-
-    # For each timestamp t, find the last segment whose start_time <= t
-    timestamp = au_df["timestamp_num"].to_numpy()
-    idx = np.searchsorted(starts, timestamp, side="right") - 1
-
-    # idx may be -1 for timestamps that come before the first segment, clip to avoid indexing errors when checking stops
-    idx_clip = np.clip(idx, 0, len(stops) - 1)
-
-    valid_timestamp = (idx >= 0) & (timestamp <= stops[idx_clip])
-
-    out = au_df.loc[valid_timestamp].copy()
-
-    # New first column "speaker" using the matched segment speaker labels
-    out.insert(0, "speaker", speakers[idx[valid_timestamp]])
-    # Convert DAIC-WOZ names to Listening (Ellie) and Speaking (Participant)
-    out["speaker"] = out["speaker"].replace({
-        "Ellie": "Listening",
-        "Participant": "Speaking",
-    })
-
-    # Restore the original timestamp string to avoid formatting changes
-    out["timestamp"] = out["timestamp_raw"]
-    out = out.drop(columns=["timestamp_raw", "timestamp_num"])
-
-    return out
+# Make the shared helpers in BachelorProject/common importable
+sys.path.insert(0, str(SCRIPT_DIR.parent))
+from common.participant_archive import GAZE_SUFFIX, archive_for_folder, find_member
+from common.manifest import Manifest
+# The labeling engine is shared with au_split_automation.py, which labels gaze in the same pass as the AUs
+from common.segment_labeler import OVERLAP_POLICIES, SegmentIndex, label_streams, labeled_path, labeler_version
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--force", action="store_true",
+                        help="relabel every participant, even the ones the manifest reports as up to date")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="label the gaze file this many frames at a time to keep memory bounded on long sessions")
+    parser.add_argument("--overlap-policy", choices=OVERLAP_POLICIES, default="last",
+                        help="how frames inside overlapping Ellie/Participant turns are labeled")
+    parser.add_argument("--label-gaps", action="store_true",
+                        help="keep frames outside every turn, labeled 'Gap', instead of dropping them")
+    args = parser.parse_args()
+
+    version = labeler_version(args.overlap_policy, args.label_gaps)
+
     for folder_name in sorted(os.listdir(ROOT_DIR)):
         folder_path = ROOT_DIR / folder_name
 
@@ -83,27 +43,38 @@ def main():
         gaze_file = folder_path / f"{participant_id}_CLNF_gaze.txt"
         segments_file = folder_path / f"{participant_id}_speaker_segments.csv"
 
-        if not gaze_file.exists():
+        # Without an extracted gaze file, read it straight out of the XXX_P.zip archive next to the folder
+        zip_path = None if gaze_file.exists() else archive_for_folder(folder_path)
+        gaze_member = find_member(zip_path, GAZE_SUFFIX) if zip_path else None
+
+        if not gaze_file.exists() and gaze_member is None:
             print(f"[{folder_name}] Missing gaze file, skipping.")
             continue
         if not segments_file.exists():
             print(f"[{folder_name}] Missing segments file, skipping.")
             continue
 
-        print(f"[{folder_name}] Processing...")
+        out_path = labeled_path("gaze", folder_path, participant_id)
 
-        segments_df = pd.read_csv(segments_file, sep=";")
-        segments_df.columns = segments_df.columns.str.strip()
+        # Skip participants whose gaze file, segments file and labeling code did not change since the last run
+        manifest = Manifest(folder_path / f"{participant_id}_manifest.json")
+        gaze_source = gaze_file if gaze_member is None else (zip_path, gaze_member)
+        inputs = manifest.fingerprints(out_path, {"segments": segments_file, "gaze": gaze_source})
+        if not args.force and manifest.is_up_to_date(out_path, inputs, version):
+            manifest.record(out_path, inputs, version)
+            manifest.save()
+            print(f"[{folder_name}] Up to date, skipping.")
+            continue
 
-        au_df = pd.read_csv(gaze_file, sep=",", engine="python", dtype=str)
-        au_df.columns = au_df.columns.str.strip()
+        print(f"[{folder_name}] Processing...")
 
-        labeled = label_timestamps_with_segments(au_df, segments_df)
+        index = SegmentIndex.from_csv(segments_file, policy=args.overlap_policy, label_gaps=args.label_gaps)
+        kept, total = label_streams(index, {"gaze": gaze_source}, {"gaze": out_path}, args.chunksize)["gaze"]
 
-        out_path = folder_path / f"{participant_id}_CLNF_gaze_labeled.csv"
-        labeled.to_csv(out_path, index=False)
+        manifest.record(out_path, inputs, version)
+        manifest.save()
 
-        print(f"[{folder_name}] Done. Kept {len(labeled)} of {len(au_df)} rows -> {out_path}")
+        print(f"[{folder_name}] Done. Kept {kept} of {total} rows -> {out_path}")
 
 
 if __name__ == "__main__":
@@ -1,6 +1,6 @@
+import sys
+import argparse
 import pandas as pd
-import numpy as np
-import statsmodels.formula.api as smf
 from pathlib import Path
 
 # Directory where the current script is located
@@ -9,8 +9,22 @@ DATA_DIR = SCRIPT_DIR.parent / "data"  # BachelorProject/data
 OUTPUT_DIR =SCRIPT_DIR.parent / "output" # BachelorProject/output
 INPUT_PATH = DATA_DIR / "gaze_aggregation.csv" # BachelorProject/data/gaze_aggregation.csv
 OUTPUT_PATH = OUTPUT_DIR / "gaze" / "gaze_permutation.csv" # BachelorProject/output/gaze/gaze_permutation.csv
+# Null distributions of earlier runs, reused by runs with the same data and seed
+CACHE_DIR = DATA_DIR / "permutation_cache" # BachelorProject/data/permutation_cache
+# Completed permutation blocks of a run in progress, for --resume
+CHECKPOINT_DIR = OUTPUT_DIR / "gaze" / "permutation_checkpoint" # BachelorProject/output/gaze/permutation_checkpoint
 
 N_PERM = 5000
+# Seed of the permutations unless --seed or --fresh-seed is given, so reruns reuse the cached null distributions
+SEED = 0
+# Processes the (stat, permutation block) tasks are spread over; None = one per CPU core
+WORKERS = None
+# Significance threshold
+ALPHA = 0.05
+
+# Make the shared helpers in BachelorProject/common importable
+sys.path.insert(0, str(SCRIPT_DIR.parent))
+from common.permutation import Checkpoint, InteractionDesign, NullCache, p_value, run_permutations
 
 def prepare_data(file):
     """
@@ -25,76 +39,85 @@ def prepare_data(file):
 
     return data_filtered
 
-def permutation_test(df, n_perm):
+def permutation_test(df, n_perm, seed=None, workers=WORKERS, adaptive=False, checkpoint=None, cache=None,
+                     metrics=("mean", "std")):
     """
-    Takes clean data and number of permutations
-    Returns p-value
+    Takes clean data, number of permutations, seed and number of worker processes
+    With adaptive, a metric stops drawing permutations once p < ALPHA is settled
+    With a checkpoint, completed permutation blocks are saved (and reused when resuming)
+    With a cache, permutation blocks of earlier runs are reused
+    Returns p-value and the number of permutations used per metric
     """
+    # value ~ depressed * segment_type per metric, set up once for all permutations
+    designs = {metric: InteractionDesign(df[df["stat"] == metric]) for metric in metrics}
 
-    # Ensure categorical
-    df["segment_type"] = df["segment_type"].astype("category")
-
-    # --- Fit real model ---
-    model = smf.ols("value ~ depressed * segment_type", data=df).fit()
-
-    interaction_term = [
-        t for t in model.params.index if "depressed:segment_type" in t
-    ][0]
-
-    T_obs = model.tvalues[interaction_term]
-
-    # --- Subject-level labels ---
-    subjects = df[["person_id", "depressed"]].drop_duplicates()
-
-    T_perm = []
-
-    for _ in range(n_perm):
-        shuffled = subjects.copy()
-        shuffled["depressed"] = np.random.permutation(shuffled["depressed"].values)
-
-        df_perm = df.drop(columns="depressed").merge(
-            shuffled, on="person_id"
-        )
+    # Interaction t of every subject level shuffle of depressed, every (stat, block) a task of the pool
+    T_perms = run_permutations(designs, n_perm, seed, workers, alpha=ALPHA if adaptive else None,
+                               checkpoint=checkpoint, cache=cache)
 
-        model_perm = smf.ols(
-            "value ~ depressed * segment_type", data=df_perm
-        ).fit()
+    results = []
 
-        T_perm.append(model_perm.tvalues[interaction_term])
+    for metric, design in designs.items():
+        T_obs = design.observed()
 
-    T_perm = np.array(T_perm)
+        # Two-sided p-value
+        p = p_value(T_obs, T_perms[metric])
 
-    # Two-sided p-value
-    p_value = np.mean(np.abs(T_perm) >= np.abs(T_obs))
+        results.append({
+            "T_obs": T_obs,
+            "p_value": p,
+            "significant": p < ALPHA,
+            "n_perm": len(T_perms[metric]),
+            "stat": metric
+        })
 
-    return pd.DataFrame([{
-        "T_obs": T_obs,
-        "p_value": p_value,
-        "significant": p_value < 0.05
-    }])
+    return pd.DataFrame(results)
 
-def main(file, n_perm):
+def main(file, n_perm, seed=None, workers=WORKERS, adaptive=False, resume=False, cache=True, fresh_seed=False):
     data = prepare_data(file)
 
-    results = []
-
-    for metric in ["mean", "std"]:
-        df_metric = data[data["stat"] == metric].copy()
-
-        res_df = permutation_test(df_metric, n_perm)
+    checkpoint = Checkpoint(CHECKPOINT_DIR, seed, resume, None if fresh_seed else SEED)
+    seed = checkpoint.seed
+    print("Seed:", seed)
 
-        # add stat column
-        res_df["stat"] = metric
-
-        results.append(res_df)
-
-    # combine results
-    results_df = pd.concat(results, ignore_index=True)
+    results_df = permutation_test(data, n_perm, seed, workers, adaptive, checkpoint,
+                                  NullCache(CACHE_DIR) if cache else None)
+    if adaptive:
+        print(f"Adaptive: {results_df['n_perm'].sum()} of {n_perm * len(results_df)} permutations drawn")
 
     results_df.to_csv(OUTPUT_PATH, index=False)
+    checkpoint.clear()
 
 if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS,
+                        help="number of worker processes (default: one per CPU core)")
+    parser.add_argument("-n", "--n-perm", type=int, default=N_PERM,
+                        help="number of permutations per stat (default: %(default)s)")
+    seeds = parser.add_mutually_exclusive_group()
+    seeds.add_argument("--seed", type=int, default=None,
+                       help="seed of the permutations; the same seed gives the same p-values "
+                            f"for any number of workers (default: {SEED})")
+    seeds.add_argument("--fresh-seed", action="store_true",
+                       help="draw a fresh seed (printed) instead of the default one; such a run cannot reuse the cache")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="stop drawing permutations for a metric once its p-value is clearly above or below "
+                             "the threshold; n_perm is then the maximum")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its last completed permutation blocks "
+                             "(with its seed, unless --seed is given)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="draw every permutation again instead of reusing the ones cached by earlier runs")
+    args = parser.parse_args()
+
     main(
         file=INPUT_PATH,
-        n_perm=N_PERM
-    )
\ No newline at end of file
+        n_perm=args.n_perm,
+        seed=args.seed,
+        workers=args.workers,
+        adaptive=args.adaptive,
+        resume=args.resume,
+        cache=not args.no_cache,
+        fresh_seed=args.fresh_seed
+    )
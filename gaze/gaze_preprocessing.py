@@ -1,50 +1,121 @@
+import re
+import sys
+import argparse
+import numpy as np
 import pandas as pd
+from contextlib import nullcontext
 from pathlib import Path
 
 CONF_THRESH = 0.7
+# If True, the gaze tables are held in the compact layout of compact_gaze (categoricals, float32 gaze vectors)
+COMPACT_DTYPES = True
 
 # Directory where the current script is located
 SCRIPT_DIR = Path(__file__).parent.resolve() # BachelorProject/gaze
+
+# Make the shared helpers in BachelorProject/common importable
+sys.path.insert(0, str(SCRIPT_DIR.parent))
+from common.frame_store import FRAME_FORMAT, DatasetWriter, participant_path, read_frames, write_partitioned
 DATA_DIR = SCRIPT_DIR.parent / "data" # BachelorProject/data
 ROOT_DIR = DATA_DIR / "participant_folders" # BachelorProject/data/participant_folders
 DEPRESSION_PATH = DATA_DIR / "depression.csv" # BachelorProject/data/depression.csv
 COMBINED_PATH = DATA_DIR / "gaze_combined_labeled.csv" # BachelorProject/data/gaze_combined_labeled.csv
 CLEANED_PATH = DATA_DIR / f"gaze_cleaned_labeled_{CONF_THRESH}.csv" # BachelorProject/data/gaze_cleaned_labeled_0.7.csv
 
-def load_all_data(base_folder:Path, depression_file:Path) -> pd.DataFrame:
+# Columns removed by the cleaning step
+NON_GAZE_COLS = ["frame", "timestamp", "confidence", "success"]
+
+# Compact layout of the gaze tables: few distinct labels per column become categoricals, frame and turn numbers int32,
+# the success flag int8 and the per eye / head gaze vectors (x_0 ... z_h1) float32. confidence and timestamp
+# stay float64, so the confidence filter keeps exactly the same frames
+CATEGORY_COLS = ["person_id", "speaker"]
+INT32_COLS = ["frame", "turn"]
+INT8_COLS = ["success"]
+GAZE_VECTOR_COL = re.compile(r"^[xyz]_h?[01]$")
+
+def compact_gaze(df:pd.DataFrame) -> pd.DataFrame:
     """
-    Loads all gaze csv files into one dataframe with a person_id column.
-    Takes folder path for all participants' data and the label file as input and returns dataframe with additional ID column and labels
+    Converts the columns of a gaze table to the compact layout (when COMPACT_DTYPES is set) and returns it
     """
-    base_path = Path(base_folder)
-    dfs = []
+    if not COMPACT_DTYPES:
+        return df
+    for col in df.columns:
+        if col in CATEGORY_COLS:
+            if not isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype("category")
+        elif col in INT32_COLS and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = df[col].astype(np.int32)
+        elif col in INT8_COLS and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = df[col].astype(np.int8)
+        elif GAZE_VECTOR_COL.match(col):
+            df[col] = df[col].astype(np.float32)
+    return df
+
+def memory_mb(df:pd.DataFrame) -> float:
+    """
+    Memory held by a table in MB, strings included
+    """
+    return df.memory_usage(deep=True).sum() / 2**20
+
+def memory_report(name:str, before:float, after:float):
+    print(f"Memory of {name}: {before:.1f} MB -> {after:.1f} MB")
 
-    for person_folder in sorted(base_path.glob("*_P")):
+def participant_files(base_folder:Path):
+    """
+    Yields the participant ID and labeled gaze file of every participant folder, in folder order.
+    Participants without a labeled file are reported and skipped
+    """
+    for person_folder in sorted(Path(base_folder).glob("*_P")):
         person_id = person_folder.name.split("_")[0]
-        file_path = person_folder / f"{person_id}_CLNF_gaze_labeled.csv"
+        if FRAME_FORMAT == "parquet":
+            file_path = participant_path("CLNF_gaze_labeled", person_id)
+        else:
+            file_path = person_folder / f"{person_id}_CLNF_gaze_labeled.csv"
 
         if not file_path.exists():
             print(f"Missing file for {person_id}")
             continue
 
-        df = pd.read_csv(file_path)
-        df.columns = df.columns.str.strip()
+        yield person_id, file_path
+
+def load_all_data(base_folder:Path, depression_file:Path) -> pd.DataFrame:
+    """
+    Loads all gaze csv files into one dataframe with a person_id column.
+    Takes folder path for all participants' data and the label file as input and returns dataframe with additional ID column and labels
+    """
+    dfs = []
+    before = 0.0
+
+    for person_id, file_path in participant_files(base_folder):
+        df = read_frames(file_path)
 
         df["person_id"] = person_id
-        dfs.append(df)
+        # every participant is compacted as it is read, so the full size layout is never held for all of them
+        before += memory_mb(df)
+        dfs.append(compact_gaze(df))
 
     if not dfs:
         raise ValueError("No gaze files found.")
 
-    data = pd.concat(dfs, ignore_index=True)
+    # concatenating categoricals with different categories gives plain values, so they are compacted again
+    data = compact_gaze(pd.concat(dfs, ignore_index=True))
+    if COMPACT_DTYPES:
+        memory_report("the combined gaze frames", before, memory_mb(data))
 
+    # mapping a categorical gives a categorical; the labels are kept as plain values
+    data["depressed"] = np.asarray(data["person_id"].map(load_depression_labels(depression_file)))
+
+    return data
+
+def load_depression_labels(depression_file:Path) -> pd.Series:
+    """
+    Depression label (PHQ8_Binary) of every participant, indexed by the participant ID as a string
+    """
     depression_values = pd.read_csv(depression_file)
 
     labelmap = depression_values.set_index("Participant_ID")["PHQ8_Binary"]
     labelmap.index = labelmap.index.astype(str)
-    data["depressed"] = data["person_id"].map(labelmap)
-
-    return data
+    return labelmap
 
 def clean_data(data:pd.DataFrame, confidence:float) ->pd.DataFrame:
     """
@@ -56,32 +127,104 @@ def clean_data(data:pd.DataFrame, confidence:float) ->pd.DataFrame:
         (data["success"] == 1)
     ]
 
-    non_gaze_cols = ["frame", "timestamp", "confidence", "success"]
-    data = data.drop(columns=non_gaze_cols)
+    data = data.drop(columns=NON_GAZE_COLS)
     data = data.set_index("person_id")
 
     return data
 
-def main(base_folder:Path, depression_file:Path, confidence:float):
+def stream_clean_data(base_folder:Path, depression_file:Path, confidence:float, combined:bool=False) -> int:
+    """
+    Streaming version of load_all_data + clean_data: every participant is filtered for confidence and success
+    while it is read, its non-gaze columns are dropped right away and it is appended to the cleaned output
+    before the next participant is read, so only one participant is in memory at a time.
+    With combined, the unfiltered frames are written to the combined output as well.
+    Returns the number of kept frames
+    """
+    labelmap = load_depression_labels(depression_file)
+    files = list(participant_files(base_folder))
+    if not files:
+        raise ValueError("No gaze files found.")
+
+    # the labels get the dtype load_all_data gives the whole column: float as soon as one participant has none
+    label_dtype = labelmap.dtype if all(person_id in labelmap.index for person_id, _ in files) else np.float64
+    kept = 0
+    combined_rows = 0
+
+    with DatasetWriter(CLEANED_PATH) as cleaned_out, \
+            (DatasetWriter(COMBINED_PATH) if combined else nullcontext()) as combined_out:
+        for person_id, file_path in files:
+            depressed = labelmap.get(person_id, np.nan)
+
+            if combined:
+                df = read_frames(file_path)
+                df["person_id"] = person_id
+                df["depressed"] = np.full(len(df), depressed, dtype=label_dtype)
+                out = compact_gaze(df.copy())
+                if FRAME_FORMAT != "parquet":
+                    # the row number column main() writes with the non-stream combined csv
+                    out.insert(0, "", np.arange(combined_rows, combined_rows + len(out)))
+                combined_out.write(out)
+                combined_rows += len(df)
+                df = df[(df["confidence"] > confidence) & (df["success"] == 1)].drop(columns=["person_id", "depressed"])
+            else:
+                df = read_frames(file_path, filters=[("confidence", ">", confidence), ("success", "==", 1)])
+
+            if df.empty:
+                continue
+
+            # same column order as clean_data: person_id, the gaze columns, depressed
+            df = df.drop(columns=NON_GAZE_COLS)
+            df.insert(0, "person_id", person_id)
+            df["depressed"] = np.full(len(df), depressed, dtype=label_dtype)
+            cleaned_out.write(compact_gaze(df))
+            kept += len(df)
+
+    return kept
+
+def main(base_folder:Path, depression_file:Path, confidence:float, stream:bool=False, write_combined:bool=True):
+
+    if stream:
+        print("Loading and cleaning data one participant at a time...")
+        kept = stream_clean_data(base_folder, depression_file, confidence, write_combined)
+        print(f"Kept frames: {kept}")
+        print(CLEANED_PATH.stem if FRAME_FORMAT == "parquet" else CLEANED_PATH)
+        return
 
     print("Loading data...")
     combined = load_all_data(base_folder, depression_file)
 
-    combined.to_csv(COMBINED_PATH)
-    print(COMBINED_PATH)
+    if FRAME_FORMAT == "parquet":
+        write_partitioned(combined, COMBINED_PATH.stem)
+        print(COMBINED_PATH.stem)
+    else:
+        combined.to_csv(COMBINED_PATH)
+        print(COMBINED_PATH)
 
     print("Cleaning data...")
     cleaned = clean_data(combined, confidence)
 
-    cleaned.to_csv(CLEANED_PATH)
-    print(CLEANED_PATH)
+    if FRAME_FORMAT == "parquet":
+        write_partitioned(cleaned, CLEANED_PATH.stem)
+        print(CLEANED_PATH.stem)
+    else:
+        cleaned.to_csv(CLEANED_PATH)
+        print(CLEANED_PATH)
 
     return
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true",
+                        help="filter and write one participant at a time instead of loading every participant at once")
+    parser.add_argument("--combined", action="store_true",
+                        help="with --stream, also write the unfiltered gaze_combined_labeled file")
+    args = parser.parse_args()
+
     main(
         base_folder=ROOT_DIR,
         depression_file=DEPRESSION_PATH,
-        confidence=CONF_THRESH
+        confidence=CONF_THRESH,
+        stream=args.stream,
+        write_combined=args.combined or not args.stream
     )
@@ -0,0 +1,119 @@
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# Directory where the current script is located
+SCRIPT_DIR = Path(__file__).parent.resolve() # BachelorProject/gaze
+DATA_DIR = SCRIPT_DIR.parent / "data" # BachelorProject/data
+ROOT_DIR = DATA_DIR / "participant_folders" # BachelorProject/data/participant_folders
+DEPRESSION_PATH = DATA_DIR / "depression.csv" # BachelorProject/data/depression.csv
+OUTPUT_PATH = DATA_DIR / "gaze_aggregation_sweep.csv" # BachelorProject/data/gaze_aggregation_sweep.csv
+
+# Confidence thresholds swept when none are given (0.5, 0.55, ..., 0.95)
+SWEEP_THRESHOLDS = [round(0.5 + 0.05 * i, 2) for i in range(10)]
+
+# Make the shared helpers in BachelorProject/common importable
+sys.path.insert(0, str(SCRIPT_DIR.parent))
+from common.frame_store import read_frames
+from common.stat_kernels import grouped_stats
+from gaze_preprocessing import load_depression_labels, participant_files
+from gaze_features import average_eyes
+from gaze_aggregation import GAZE_STATS, OUTPUT_COLUMNS, gaze_kernels
+
+SEGMENTS = ["all", "listening", "speaking"]
+
+def participant_deltas(df:pd.DataFrame, thresholds:list) -> dict:
+    """
+    Gaze deltas (degrees) of one participant for every threshold, the same values gaze_preprocessing.py and
+    gaze_features.py produce with CONF_THRESH set to that threshold. A delta depends on which frame was kept
+    before it, so the deltas are recomputed per threshold, but from the frames read and averaged once.
+    Returns {segment: (deltas, threshold index of every delta, number of frames kept at every threshold)}
+    """
+    df = average_eyes(df)
+    vectors = df[["x_avg", "y_avg", "z_avg"]].to_numpy()
+    confidence = df["confidence"].to_numpy()
+    speaker = df["speaker"].to_numpy(dtype=object)
+
+    out = {segment: ([], [], []) for segment in SEGMENTS}
+    for i, t in enumerate(thresholds):
+        kept = np.flatnonzero(confidence > t)
+        v, sp = vectors[kept], speaker[kept]
+
+        # delta between every kept frame and the kept frame before it
+        dot = np.einsum("ij,ij->i", v[1:], v[:-1])
+        delta = np.rad2deg(np.arccos(np.clip(dot, -1, 1)))
+
+        # listening/speaking deltas only within a run of frames of the same speaker
+        same_run = sp[1:] == sp[:-1]
+        for segment, keep, frames in (
+            ("all", slice(None), len(sp)),
+            ("listening", same_run & (sp[1:] == "Listening"), np.sum(sp == "Listening")),
+            ("speaking", same_run & (sp[1:] == "Speaking"), np.sum(sp == "Speaking")),
+        ):
+            values = delta[keep]
+            out[segment][0].append(values)
+            out[segment][1].append(np.full(len(values), i))
+            out[segment][2].append(frames)
+
+    return {segment: (np.concatenate(d), np.concatenate(ids), np.array(n)) for segment, (d, ids, n) in out.items()}
+
+def sweep_participant(person_id:str, file_path:Path, thresholds:list, kernels:dict) -> pd.DataFrame:
+    """
+    Long-format gaze statistics of one participant for every threshold, from one read of its labeled file
+    """
+    df = read_frames(file_path, filters=[("success", "==", 1), ("confidence", ">", min(thresholds))])
+
+    rows = []
+    for segment, (deltas, ids, frames) in participant_deltas(df, thresholds).items():
+        # one grouped pass over the deltas of every threshold
+        result = grouped_stats(deltas, ids, len(thresholds), kernels)[:, 0, :]
+        # as in gaze_aggregation.py, a segment with frames but no delta gets rows with NaN values
+        for i in np.flatnonzero(frames > 0):
+            rows.append(pd.DataFrame({
+                "conf_thresh": thresholds[i],
+                "person_id": int(person_id),
+                "stat": list(kernels),
+                "segment_type": segment,
+                "value": result[i],
+            }))
+
+    return pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=["conf_thresh"] + OUTPUT_COLUMNS)
+
+def main(base_folder:Path, depression_file:Path, thresholds:list, stats=None):
+
+    kernels = gaze_kernels(stats)
+
+    print("Sweeping thresholds:", thresholds)
+    dfs = [sweep_participant(person_id, file_path, thresholds, kernels)
+           for person_id, file_path in participant_files(base_folder)]
+
+    if not dfs:
+        raise ValueError("No gaze files found.")
+
+    combined = pd.concat(dfs, ignore_index=True)
+    combined["depressed"] = combined["person_id"].astype(str).map(load_depression_labels(depression_file))
+
+    # one block per threshold, each in the order of gaze_aggregation.csv
+    combined = combined[["conf_thresh"] + OUTPUT_COLUMNS].sort_values(["conf_thresh", "person_id", "segment_type", "stat"])
+    combined.to_csv(OUTPUT_PATH, index=False)
+    print(OUTPUT_PATH)
+
+    return
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--thresholds", default=",".join(map(str, SWEEP_THRESHOLDS)),
+                        help="comma separated confidence thresholds (default: %(default)s)")
+    parser.add_argument("--stats", default=",".join(GAZE_STATS),
+                        help="comma separated statistics to compute (default: %(default)s)")
+    args = parser.parse_args()
+
+    main(
+        base_folder=ROOT_DIR,
+        depression_file=DEPRESSION_PATH,
+        thresholds=sorted(float(t) for t in args.thresholds.split(",") if t.strip()),
+        stats=[k.strip() for k in args.stats.split(",") if k.strip()]
+    )